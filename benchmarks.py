@@ -0,0 +1,129 @@
+import os
+import sys
+import timeit
+import subprocess
+import numpy as np
+import power_spectrum_analytic as psa
+import cosmo_parameters as cp
+
+
+def transfer_benchmark(nk=10000, repeat=200):
+    """
+    Times the in place transfer function against the direct transcription of Eisenstein and Hu
+    :param nk: int : number of wavenumbers, 10 000 in a sigma(R) integral
+    :param repeat: int : number of evaluations timed
+    :return: dict : time per call in seconds of each version, and maximum absolute difference of the results
+    """
+    k = np.logspace(-7, 5, nk)
+    work = psa.transfer_workspace(k.shape)
+    res = {'reference': min(timeit.repeat(lambda: psa.transfer_reference(k), number=repeat, repeat=3)) / repeat,
+           'transfer': min(timeit.repeat(lambda: psa.transfer(k), number=repeat, repeat=3)) / repeat,
+           'transfer with workspace': min(timeit.repeat(lambda: psa.transfer(k, work=work), number=repeat,
+                                                        repeat=3)) / repeat,
+           'max difference': np.max(np.abs(psa.transfer(k) - psa.transfer_reference(k)))}
+    return res
+
+
+def import_benchmark(modules=('cosmo_parameters', 'fluctuation_rms', 'halo_mass_function', 'formation_time'),
+                     repeat=5):
+    """
+    Times the import of each module in a fresh interpreter, as done by a new worker process, minus the start up time of
+    the interpreter itself
+    :param modules: list of str : names of the modules
+    :param repeat: int : number of interpreters started per module, the fastest is kept
+    :return: dict : import time in seconds of each module, and the optional backends it loaded
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    backends = ('colossus', 'camb', 'astropy', 'autograd', 'scipy')
+
+    def run(statement):
+        return subprocess.run([sys.executable, '-c', statement], env=env, check=True, capture_output=True, text=True)
+
+    def best(statement):
+        return min(timeit.repeat(lambda: run(statement), number=1, repeat=repeat))
+
+    start = best('pass')
+    res = {}
+    for name in modules:
+        loaded = run('import sys, %s; print(" ".join(el for el in %r if el in sys.modules))' % (name, backends))
+        res[name] = (best('import ' + name) - start, loaded.stdout.split())
+    return res
+
+
+def _reference_main_branch(Mi, Mres, ws, rng, eps1=0.1, eps2=0.1, frac=0.5):
+    """
+    Main branch of a tree of the binary split algorithm of Cole et al. (2000), i.e. Parkinson, Cole & Helly (2008) with
+    G=1, written halo step by halo step with direct integrals of the EPS progenitor distribution and its exact inverse.
+    It only shares the sigma spline with formation_time_MC.merger_tree.
+    :param Mi: float : mass of the root halo
+    :param Mres: float : mass resolution
+    :param ws: array : increasing delta_c of the output redshifts, the first one of the root
+    :param rng: numpy.random.Generator
+    :return: array : mass of the main branch at each output redshift
+    """
+    import formation_time_MC as fmc
+    from scipy.integrate import quad
+    from scipy.optimize import brentq
+    spline, dspline = fmc.sigma_spline()
+
+    def S(m):
+        return np.exp(spline(np.log(m)))
+
+    Sres = S(Mres)
+    M, w, res = Mi, ws[0], [Mi]
+    for wnext in ws[1:]:
+        while w < wnext and M > Mres / frac:
+            S0 = S(M)
+
+            def dens(l1):  # dN/dw dln M1 of EPS
+                return M / np.exp(l1) * S(np.exp(l1)) * abs(dspline(l1)) * (S(np.exp(l1)) - S0) ** -1.5 / \
+                    np.sqrt(2 * np.pi)
+
+            lo, hi = np.log(Mres), np.log(frac * M)
+            rate = quad(dens, lo, hi, limit=200)[0]
+            dw = min(eps1 * np.sqrt(2 * (S(frac * M) - S0)), eps2 / rate, wnext - w)
+            r = rng.random() / (rate * dw)
+            M1 = 0
+            if r < 1:
+                M1 = np.exp(brentq(lambda l: quad(dens, lo, l, limit=200)[0] - r * rate, lo, hi, xtol=1e-10))
+            M2 = M * (1 - np.sqrt(2 / np.pi) * dw / np.sqrt(Sres - S0)) - M1
+            M = max(M1, M2)
+            w += dw
+        res.append(M)
+    return np.array(res)
+
+
+def tree_benchmark(ntrees=1000, Mi=1e12, Mres=1e10, zgrid=(0.3, 0.6, 1.0, 1.4, 2.0), eps=0.1, seed=0):
+    """
+    Formation redshifts of binary split merger trees in their EPS limit (G0=1, gamma1=gamma2=0) : P(z_f > z) from
+    formation_time_MC.merger_tree, from the independent implementation _reference_main_branch, and from the EPS
+    formula formation_time.proba
+    :param ntrees: int : number of trees of each implementation
+    :param Mi: float : mass of the root halo at z=0
+    :param Mres: float : mass resolution
+    :param zgrid: list of floats : redshifts, multiples of 0.05
+    :param eps: float : eps1 and eps2 of both implementations
+    :param seed: int : seed of the random numbers
+    :return: dict : P(z_f > z) on zgrid and its standard deviation for each implementation, the EPS prediction
+    """
+    import formation_time as ft
+    import formation_time_MC as fmc
+    zgrid = np.asarray(zgrid)
+    rng = np.random.default_rng(seed)
+    kwargs = dict(eps1=eps, eps2=eps, G0=1, gamma1=0, gamma2=0)
+    zf = np.array([fmc.formation_redshift(fmc.merger_tree(0, Mi, Mres, zgrid[-1] + 0.1, 0.05, rng=rng, **kwargs))
+                   for i in range(ntrees)])
+    tree = np.mean(zf[:, None] > zgrid, axis=0)
+    ws = cp.delta_c(np.concatenate([[0], zgrid]))
+    masses = np.array([_reference_main_branch(Mi, Mres, ws, rng, eps, eps) for i in range(ntrees)])
+    ref = np.mean(masses[:, 1:] > 0.5 * Mi, axis=0)
+    return {'merger_tree': (tree, np.sqrt(tree * (1 - tree) / ntrees)),
+            'reference': (ref, np.sqrt(ref * (1 - ref) / ntrees)),
+            'EPS': ft.proba_grid(Mi, zgrid, model='PS', colos=True)[0]}
+
+
+if __name__ == "__main__":
+    for key, val in transfer_benchmark().items():
+        print('%s : %.3g' % (key, val))
+    for key, (val, loaded) in import_benchmark().items():
+        print('import %s : %.3g s, loads %s' % (key, val, ', '.join(loaded) or 'no optional backend'))
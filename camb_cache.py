@@ -0,0 +1,220 @@
+import os
+import json
+import shutil
+import hashlib
+import inspect
+import tempfile
+import functools
+import numpy as np
+
+cache_dir = os.environ.get('HALO_CAMB_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'halo_formation_time', 'camb'))
+max_cache_size = 2 ** 30  # bytes kept on disk before the least recently used spectra are evicted
+version = 1  # to be increased whenever the stored spectra change for identical arguments
+
+
+########################################################################################################################
+
+##################################-----------------------Storage----------------------##################################
+
+########################################################################################################################
+
+
+def _normalise(value):
+    """Numbers as floats and sequences as lists, so that kmax=30 and kmax=30.0 give the same key"""
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_normalise(el) for el in value]
+    if isinstance(value, dict):
+        return {key: _normalise(el) for key, el in value.items()}
+    return value
+
+
+def cache_key(arguments, name=''):
+    """
+    Content address of a set of arguments
+    :param arguments: dict : name and value of every argument of the cached function, defaults included
+    :param name: str : qualified name of the cached function, so that two functions never share entries
+    :return: str : sha256 hex digest
+    """
+    text = json.dumps({'version': version, 'function': name, 'arguments': _normalise(arguments)}, sort_keys=True,
+                      default=repr)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def load(key, mmap=True):
+    """
+    Result stored under key. Arrays are memory mapped read only if mmap.
+    :param key: str : cache key
+    :param mmap: bool : memory map the arrays instead of reading them
+    :return: tuple of arrays or list of tuples of arrays as returned by the cached function. None if absent
+    """
+    path = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(path, 'layout.json')) as f:
+            layout = json.load(f)
+        arrays = [np.load(os.path.join(path, '%d.npy' % i), mmap_mode='r' if mmap else None)
+                  for i in range(sum(layout))]
+        os.utime(path)  # the modification time orders the entries for the LRU eviction
+    except (OSError, ValueError, EOFError):
+        return None
+    if len(layout) == 1:
+        return tuple(arrays)
+    groups, start = [], 0
+    for n in layout:
+        groups.append(list(arrays[start:start + n]))
+        start += n
+    return tuple(groups)
+
+
+def save(key, result):
+    """
+    Stores a tuple of arrays, or a sequence of lists of arrays, as .npy files under key. The entry is written in a
+    temporary directory and renamed, so concurrent processes never read a partial entry. An existing entry is kept if
+    it can be read, and replaced otherwise.
+    :param key: str : cache key
+    :param result: tuple of arrays or sequence of lists of arrays
+    :return: None
+    """
+    if all(isinstance(el, (list, tuple)) for el in result):
+        layout = [len(el) for el in result]
+        arrays = [arr for el in result for arr in el]
+    else:
+        layout = [len(result)]
+        arrays = list(result)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp')
+    for i, arr in enumerate(arrays):
+        np.save(os.path.join(tmp, '%d.npy' % i), np.asarray(arr))
+    with open(os.path.join(tmp, 'layout.json'), 'w') as f:
+        json.dump(layout, f)
+    path = os.path.join(cache_dir, key)
+    try:
+        os.rename(tmp, path)
+    except OSError:  # written by another process in the meantime, or corrupt
+        if load(key, mmap=False) is None:
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+    evict()
+
+
+def entries():
+    """
+    Cached entries, least recently used first
+    :return: list of (key, size in bytes, last use time)
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    res = []
+    for key in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, key)
+        if key.startswith('.') or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, el)) for el in os.listdir(path))
+        res.append((key, size, os.path.getmtime(path)))
+    return sorted(res, key=lambda el: el[2])
+
+
+def evict(max_size=None):
+    """
+    Removes the least recently used entries until the cache is smaller than max_size
+    :param max_size: int : size in bytes. Default : module value max_cache_size. 0 empties the cache
+    :return: int : number of removed entries
+    """
+    if max_size is None:
+        max_size = max_cache_size
+    cached = entries()
+    total = sum(el[1] for el in cached)
+    removed = 0
+    for key, size, _ in cached:
+        if total <= max_size:
+            break
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+        removed += 1
+    return removed
+
+
+def disk_cache(func):
+    """
+    Decorator storing the results of func on disk, addressed by the values of all of its arguments. The decorated
+    function takes an extra keyword argument cache, False to bypass the cache.
+    """
+    signature = inspect.signature(func)
+    name = func.__module__ + '.' + func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, cache=True, **kwargs):
+        if not cache:
+            return func(*args, **kwargs)
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = cache_key(dict(bound.arguments), name)
+        res = load(key)
+        if res is None:
+            res = func(*args, **kwargs)
+            save(key, res)
+        return res
+    return wrapper
+
+
+########################################################################################################################
+
+##################################-----------------------Warm up----------------------##################################
+
+########################################################################################################################
+
+
+def warm_up(sig8s, hs, om0s, ol0s, ombs, nss, kmax=30, prec=1000):
+    """
+    Computes and stores the CAMB spectra of every combination of parameters, with the arguments used by
+    fluctuation_rms.sigma_R(camb=True) and camb_fluctuation_rms.sigma_camb_R so that later calls of both are read from
+    disk.
+    :return: int : number of spectra
+    """
+    import itertools
+    import fluctuation_rms as fm
+    import camb_fluctuation_rms as cfm
+    n = 0
+    for sig8, h, om0, ol0, omb, ns in itertools.product(sig8s, hs, om0s, ol0s, ombs, nss):
+        for func in (fm.camb_power_spectrum, cfm.camb_power_spectrum):
+            func(h=h, kmax=kmax, ombh2=omb * h ** 2, omch2=(om0 - omb) * h ** 2, sig8=sig8, npoints=prec, ns=ns,
+                 omk=1 - om0 - ol0, nonlinear=False, linear=True)
+        n += 1
+    return n
+
+
+if __name__ == "__main__":
+    import argparse
+    import cosmo_parameters as cp
+
+    parser = argparse.ArgumentParser(description='Fills or cleans the on-disk cache of CAMB power spectra in '
+                                                 + cache_dir)
+    parser.add_argument('--sig8', type=float, nargs='+', default=[cp.sigma8])
+    parser.add_argument('--h', type=float, nargs='+', default=[cp.h])
+    parser.add_argument('--om0', type=float, nargs='+', default=[cp.om])
+    parser.add_argument('--ol0', type=float, nargs='+', default=[cp.oml])
+    parser.add_argument('--omb', type=float, nargs='+', default=[cp.omb])
+    parser.add_argument('--ns', type=float, nargs='+', default=[cp.ns])
+    parser.add_argument('--kmax', type=float, default=30)
+    parser.add_argument('--prec', type=int, default=1000)
+    parser.add_argument('--evict', type=float, default=None, help='only evict down to this size in MB')
+    parser.add_argument('--info', action='store_true', help='only print the content of the cache')
+    opts = parser.parse_args()
+
+    if opts.info:
+        cached = entries()
+        print('%d spectra, %.1f MB in %s' % (len(cached), sum(el[1] for el in cached) / 2 ** 20, cache_dir))
+    elif opts.evict is not None:
+        print('%d spectra removed' % evict(int(opts.evict * 2 ** 20)))
+    else:
+        print('%d spectra cached' % warm_up(opts.sig8, opts.h, opts.om0, opts.ol0, opts.omb, opts.ns, opts.kmax,
+                                            opts.prec))
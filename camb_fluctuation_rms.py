@@ -1,10 +1,7 @@
 import cosmo_parameters as cp
+import fluctuation_rms as fm
+import camb_cache
 import numpy as np
-import camb
-from camb import model
-from colossus.cosmology import cosmology
-
-cosmo = cosmology.setCosmology('planck15');
 
 
 ##################################----------------------Filters-----------------------##################################
@@ -29,6 +26,7 @@ def W_ksharp(k, R):
 
 #################################------------------CAMB POWER SPECTRUM-----------------####################################
 
+@camb_cache.disk_cache
 def camb_power_spectrum(h=cp.h, ombh2=cp.ombh2, omch2=cp.omch2, ns=cp.ns, sig8=cp.sigma8, kmin=2e-5, kmax=
 100, linear=True, npoints=1000, nonlinear=False, omk=0.0, cosmomc_theta=None, thetastar=None,
                         neutrino_hierarchy='degenerate', num_massive_neutrinos=1, mnu=0.06, nnu=3.046, YHe=None,
@@ -41,7 +39,10 @@ def camb_power_spectrum(h=cp.h, ombh2=cp.ombh2, omch2=cp.omch2, ns=cp.ns, sig8=c
     ns : float initial power spectrum index
     kmax : max value of wave number for calculating the power spectrum
     nonlinear/linear : Boolean, if wanting the nonlinear/linear power spectrum for result
-    npoints : number of desired points for the power spectrum restult"""
+    npoints : number of desired points for the power spectrum restult
+    cache : Boolean, if False recomputes the spectrum instead of reading it from the on-disk cache (see camb_cache)"""
+    import camb
+    from camb import model
     pars = camb.CAMBparams()
     pars.set_cosmology(100 * h, ombh2, omch2, omk, cosmomc_theta, thetastar, neutrino_hierarchy,
                        num_massive_neutrinos, mnu, nnu, YHe, meffsterile, standard_neutrino_neff, TCMB,
@@ -70,12 +71,83 @@ def camb_power_spectrum(h=cp.h, ombh2=cp.ombh2, omch2=cp.omch2, ns=cp.ns, sig8=c
         return [kh, zs, norm * pk[0]], [kh_nonlin, z_nonlin, norm * pk_nonlin[0]]
 
 
+@camb_cache.disk_cache
+def camb_power_spectrum_z(redshifts=(0,), h=cp.h, ombh2=cp.ombh2, omch2=cp.omch2, ns=cp.ns, sig8=cp.sigma8, kmin=2e-5,
+                          kmax=100, npoints=1000, nonlinear=False, omk=0.0, mnu=0.06, nnu=3.046, TCMB=2.7255, **kwargs):
+    """Linear (and nonlinear) power spectra of one cosmology at several redshifts from a single CAMB run
+    Variables :
+    redshifts : list of redshifts of the spectra
+    cosmological parameters in camb.set_cosmo (see camb.set_cosmo for reference), other keywords are passed to it
+    sig8 : float sigma8 at z=0 used to normalise the spectra
+    nonlinear : Boolean, if also returning the nonlinear power spectrum
+    npoints : number of desired points for the power spectrum result
+    cache : Boolean, if False recomputes the spectra instead of reading them from the on-disk cache (see camb_cache)
+    returns : kh (npoints,), pk (len(redshifts), npoints) in the order of redshifts (, nonlinear pk)"""
+    import camb
+    from camb import model
+    redshifts = np.atleast_1d(redshifts)
+    zs = sorted(set(redshifts.tolist()) | {0.0}, reverse=True)  # z=0 is needed for the sigma8 normalisation
+    pars = camb.CAMBparams()
+    pars.set_cosmology(H0=100 * h, ombh2=ombh2, omch2=omch2, omk=omk, mnu=mnu, nnu=nnu, TCMB=TCMB, **kwargs)
+    pars.InitPower.set_params(ns=ns)
+    pars.set_matter_power(redshifts=zs, kmax=kmax)
+    pars.NonLinear = model.NonLinear_none
+    results = camb.get_results(pars)
+    norm = (sig8 / results.get_sigma8_0()) ** 2
+    kh, zout, pk = results.get_matter_power_spectrum(minkh=kmin, maxkh=kmax, npoints=npoints)
+    index = [list(zout).index(el) for el in redshifts]  # camb sorts the redshifts
+    if not nonlinear:
+        return kh, norm * pk[index]
+    pars.NonLinear = model.NonLinear_both
+    results.calc_power_spectra(pars)
+    kh_nonlin, z_nonlin, pk_nonlin = results.get_matter_power_spectrum(minkh=kmin, maxkh=kmax, npoints=npoints)
+    return kh, norm * pk[index], norm * pk_nonlin[index]
+
+
+def _camb_batch_worker(kwargs):
+    """One cosmology of camb_power_spectra. Defined at module level to be sent to the worker processes"""
+    return camb_power_spectrum_z(**kwargs)
+
+
+def camb_power_spectra(cosmologies, redshifts=(0,), kmin=2e-5, kmax=100, npoints=1000, nonlinear=False, processes=None,
+                       cache=True):
+    """
+    Power spectra of a list of cosmologies at a list of redshifts. Every cosmology is one CAMB run done by a worker of a
+    process pool, each worker keeping its own CAMB instance.
+    :param cosmologies: list of dict : keyword arguments of camb_power_spectrum_z for each cosmology (h, ombh2, omch2,
+    ns, sig8, omk...)
+    :param redshifts: list of floats : redshifts of the spectra
+    :param kmin: float : minimum wavenumber in h/Mpc
+    :param kmax: float : maximum wavenumber in h/Mpc
+    :param npoints: int : number of log spaced wavenumbers
+    :param nonlinear: bool : also returns the nonlinear power spectra
+    :param processes: int : number of worker processes. Default : number of cpus. 1 runs serially
+    :param cache: bool : read and store the spectra in the on-disk cache
+    :return: kh (npoints,), pk (npoints, len(redshifts), len(cosmologies)) (, nonlinear pk of the same shape)
+    """
+    tasks = [dict(cosmo, redshifts=tuple(np.atleast_1d(redshifts).tolist()), kmin=kmin, kmax=kmax, npoints=npoints,
+                  nonlinear=nonlinear, cache=cache) for cosmo in cosmologies]
+    if processes == 1:
+        res = [_camb_batch_worker(task) for task in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            res = list(executor.map(_camb_batch_worker, tasks))
+    kh = np.asarray(res[0][0])
+    pk = np.stack([el[1] for el in res], axis=-1).transpose(1, 0, 2)  # (npoints, nz, ncosmo)
+    if not nonlinear:
+        return kh, pk
+    return kh, pk, np.stack([el[2] for el in res], axis=-1).transpose(1, 0, 2)
+
+
 def Delta_camb(k, h=cp.h, omb=cp.omb, om0=cp.om, ns=cp.ns, sig8=cp.sigma8, omk=0.0, cosmomc_theta=None,
                thetastar=None, neutrino_hierarchy='degenerate',
                num_massive_neutrinos=1, mnu=0.06, nnu=3.046, YHe=None,
                meffsterile=0.0, standard_neutrino_neff=3.046, TCMB=2.7255,
                tau=None, deltazrei=None, Alens=1.0, bbn_predictor=None,
                theta_H0_range=(10, 100)):
+    import camb
+    from camb import model
     if type(k) == list or type(k) == np.ndarray:
         kmin = np.min(k)
         kmax = np.max(k)
@@ -108,37 +180,24 @@ def Delta_camb(k, h=cp.h, omb=cp.omb, om0=cp.om, ns=cp.ns, sig8=cp.sigma8, omk=0
 ################################----------------Fluctuation RMS---------------------###################################
 
 
-def sigma_camb_R(R, sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ol0=cp.oml, ns=cp.ns, kmax=30, prec=1000, window=W_th):
+def sigma_camb_R(R, sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ol0=cp.oml, ns=cp.ns, kmax=30, prec=1000, window=W_th,
+                 quad='rect', err=False):
     """
     :param M: Mass, could be an nd.array
     :param k: wavenumbers for calculating the integral nd array
     :param pk: power spectrum values nd array same size as k
     :param window: function. Smoothing window function
+    :param quad: str : quadrature of the k integral. Either 'rect', 'simpson', 'gauss' or 'fftlog'
+    :param err: boolean : if True also returns an estimate of the absolute integration error
     :return: nd array : values of the rms of the smoothed density field for the mass array entered
     """
     ombh2 = omb * h ** 2
     omch2 = (om0 - omb) * h ** 2
     k, z, pk = camb_power_spectrum(h=h, kmax=kmax, ombh2=ombh2, omch2=omch2, sig8=sig8, npoints=prec,
                                    ns=ns, omk=1 - om0 - ol0, nonlinear=False, linear=True)
-    if type(R) == list or type(R) == np.ndarray:
-        # In units of Mpc/h
-        n = len(R)  # size of Mass imput
-        m = prec  # size of wavenumbers imput
-        Rmat = np.array([R] * m)  # Duplicating the R 1D array to get a n*m size matric
-        kmat = np.array([k] * n).transpose()  # Dupicating the k and pk 1D arrays to get n*m size matrix
-        pkmat = np.array([pk] * n).transpose()
-
-        winres = window(kmat, Rmat)  # Calculating every value of the window function without a boucle
-        dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
-        res = pkmat * kmat ** 3 * winres ** 2  # Values inside the integral foreach k
-        integ = np.sum(res, axis=0) * dlk  # approximate evaluation of the integral through k.
-        return np.sqrt(integ / (2 * np.pi ** 2))
-    else:
-        winres = window(k, R)
-        dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
-        res = pk * k ** 3 * winres ** 2
-        integ = np.sum(res) * dlk
-        return np.sqrt(integ / (2 * np.pi ** 2))
+    if quad == 'gauss':
+        return fm.sigma_gauss(R, fm.interp_power_spectrum(k, pk), np.min(k), np.max(k), window, err=err)
+    return fm.sigma_integral(R, k, pk, window, quad=quad, err=err)
 
 
 def sigma_camb(x, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', xin='M', prec=1000, om0=cp.om, ol0=cp.oml,
@@ -170,6 +229,9 @@ def sigma_camb(x, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', xin='M', pre
 
 
 if __name__ == "__main__":
+    from colossus.cosmology import cosmology
+
+    cosmo = cosmology.setCosmology('planck15')
     '''
     import matplotlib.pyplot as plt
     ks = np.logspace(-3, 2, 10000)
@@ -1,5 +1,5 @@
 import numpy as np
-from astropy.cosmology import LambdaCDM, z_at_value
+from functools import lru_cache
 
 ### Fundamental set of parameters
 G = 4.30091e-9   #Units Mpc/Msun x (km/s)^2
@@ -76,17 +76,30 @@ def growth(z, om0=om, ol0=oml):
     om = omega_m(z, om0, ol0)     #Matter density at z
     return (5*om/2)*1/(om**(4/7)-ol+(1+om/2)*(1+ol/70))
 
+@lru_cache(maxsize=128)
+def _growth0_cached(om0, ol0):
+    return growth(0, om0, ol0)
+
+def growth0(om0=om, ol0=oml):
+    """Linear growth factor today, computed once per cosmology. Arrays of cosmologies are computed directly"""
+    if np.ndim(om0) == np.ndim(ol0) == 0:
+        return _growth0_cached(float(om0), float(ol0))
+    return growth(0, om0, ol0)
+
 def D(z, om0, ol0):
     """Normalised linear growth factor"""
-    return growth(z, om0, ol0)/((1+z)*growth(0, om0, ol0))
+    return growth(z, om0, ol0)/((1+z)*growth0(om0, ol0))
 
 def delta_c(z, om0=om, ol0=oml):
     """critical overdensity"""
-    return 1.686*growth(0, om0, ol0)*(1+z)/growth(z, om0, ol0)
+    return 1.686*growth0(om0, ol0)*(1+z)/growth(z, om0, ol0)
 def delta_ec(z, sig, om0=om, ol0=oml):
-    return np.sqrt(0.707)*delta_c(z, om0, ol0)*(1 + 0.47*(sig**2/delta_c(z, om0, ol0)**2)**0.615)
+    dc = delta_c(z, om0, ol0)
+    return np.sqrt(0.707)*dc*(1 + 0.47*(sig**2/dc**2)**0.615)
 
 def infall_time(z, h=h, om=om):
+    from astropy import units as u
+    from astropy.cosmology import LambdaCDM, z_at_value
     cosmo = LambdaCDM(H0=100*h, Om0=om, Ode0=1-om)
     infall = 1.44 / hubble_ratio(z, omega_m0=om, omega_l0=1-om)
     ages = cosmo.age(z).value
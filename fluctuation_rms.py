@@ -1,9 +1,16 @@
 import power_spectrum_analytic as psa
 import cosmo_parameters as cp
-from colossus.cosmology import cosmology
+import camb_cache
 import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
 
-cosmo = cosmology.setCosmology('planck15');
+max_mem = 2 ** 28  # memory budget in bytes for the temporaries of the sigma(R) integral
+max_sigma_tables = 8  # number of cosmologies for which a sigma(R) interpolation table is kept in memory
+_sigma_tables = OrderedDict()  # LRU cache of the sigma(R) tables, the most recently used is last
+sigma_tab_prec = 30  # number of R bins per decade of the sigma(R) tables
+max_colossus_cosmologies = 8  # number of Colossus cosmology objects kept alive
+_colossus_cosmologies = OrderedDict()  # LRU cache of the Colossus cosmologies, the most recently used is last
 
 
 def W_th(k, R):
@@ -39,11 +46,30 @@ def power_spectrum(k, sigma8=cp.sigma8, h=cp.h, om0=cp.om, omb=cp.omb, ns=cp.ns,
     if test:
         return k ** ns * psa.transfer(k * h, om0, omb, h) ** 2  # getting a first value
     else:
-        val_8 = sigma_R(8, sigma8, h, omb, om0, test=True)  # getting the value of sigma8
-        return (sigma8 / val_8) ** 2 * k ** ns * psa.transfer(k * h, om0, omb,
+        return power_spectrum_norm(sigma8, h, om0, omb, ns) * k ** ns * psa.transfer(k * h, om0, omb,
                                                           h) ** 2  # normalising by the value of sigma8 we want
 
 
+@lru_cache(maxsize=128)
+def _sigma8_unnormalised(h, om0, omb, ns):
+    """sigma(8 Mpc/h) of the non normalised power spectrum. Cached since it only depends on the cosmology"""
+    return sigma_R(8, 1, h, omb, om0, ns=ns, test=True)
+
+
+def power_spectrum_norm(sigma8=cp.sigma8, h=cp.h, om0=cp.om, omb=cp.omb, ns=cp.ns):
+    """
+    Normalisation of the Eisenstein and Hu power spectrum such that sigma(8 Mpc/h) = sigma8. The integral is done once
+    per (h, om0, omb, ns) and reused afterwards
+    :param sigma8: float: sigma 8 cosmo param
+    :param h: float : H0/100 : cosmo parameter
+    :param om0: faction matter density
+    :param omb: float : fraction baryon density
+    :param ns: float : initial spectrum power law index
+    :return: float : amplitude multiplying k**ns T(k)**2
+    """
+    return (sigma8 / _sigma8_unnormalised(float(h), float(om0), float(omb), float(ns))) ** 2
+
+
 def Delta(k, sigma8=cp.sigma8, h=cp.h, om0=cp.om, omb=cp.omb, ns=cp.ns):
     """
     dimenstionless power spectrum function
@@ -59,6 +85,7 @@ def Delta(k, sigma8=cp.sigma8, h=cp.h, om0=cp.om, omb=cp.omb, ns=cp.ns):
     return np.sqrt(k ** 3 * power_spectrum(k, sigma8, h, om0, omb, ns) / (2 * np.pi ** 2))
 
 
+@camb_cache.disk_cache
 def camb_power_spectrum(h=cp.h, ombh2=cp.ombh2, omch2=cp.omch2, ns=cp.ns, sig8=cp.sigma8, kmin=2e-5, kmax=100, linear=True,
                         npoints=1000, nonlinear=False, omk=0.0, cosmomc_theta=None, thetastar=None,
                         neutrino_hierarchy='degenerate', num_massive_neutrinos=1, mnu=0.06, nnu=3.046, YHe=None,
@@ -70,7 +97,8 @@ def camb_power_spectrum(h=cp.h, ombh2=cp.ombh2, omch2=cp.omch2, ns=cp.ns, sig8=c
     ns : float initial power spectrum index
     kmax : max value of wave number for calculating the power spectrum
     nonlinear/linear : Boolean, if wanting the nonlinear/linear power spectrum for result
-    npoints : number of desired points for the power spectrum restult"""
+    npoints : number of desired points for the power spectrum restult
+    cache : Boolean, if False recomputes the spectrum instead of reading it from the on-disk cache (see camb_cache)"""
     import camb
     from camb import model
     pars = camb.CAMBparams()
@@ -101,8 +129,36 @@ def camb_power_spectrum(h=cp.h, ombh2=cp.ombh2, omch2=cp.omch2, ns=cp.ns, sig8=c
         return ([kh, zs, norm * pk[0]], [kh_nonlin, z_nonlin, norm * pk_nonlin[0]])
 
 
+def colossus_cosmology(sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ol0=cp.oml, ns=cp.ns):
+    """
+    Colossus cosmology object for a set of parameters, made the current Colossus cosmology. Each cosmology is created
+    once, later calls only switch back to it, which keeps the interpolation tables Colossus builds on the object. Up to
+    max_colossus_cosmologies objects are stored and the least recently used one is dropped first.
+    :param sig8: float: sigma 8 cosmological parameter
+    :param h: float : H0/100 cosmo parameter
+    :param omb: float : baryon fraction density
+    :param om0: float : matter fraction density
+    :param ol0: float : dark energy fraction density
+    :param ns: float : initial power spectrum power law index
+    :return: colossus.cosmology.cosmology.Cosmology : the current cosmology
+    """
+    from colossus.cosmology import cosmology
+    key = (sig8, h, omb, om0, ol0, ns)
+    if key in _colossus_cosmologies:
+        _colossus_cosmologies.move_to_end(key)
+        cosmo = _colossus_cosmologies[key]
+        cosmology.setCurrent(cosmo)
+        return cosmo
+    my_cosmo = {'flat': True, 'H0': 100 * h, 'Om0': om0, 'Ode0': ol0, 'Ob0': omb, 'sigma8': sig8, 'ns': ns}
+    cosmo = cosmology.setCosmology('my_cosmo', my_cosmo)
+    _colossus_cosmologies[key] = cosmo
+    if len(_colossus_cosmologies) > max_colossus_cosmologies:
+        _colossus_cosmologies.popitem(last=False)
+    return cosmo
+
+
 def sigma_R(R, sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ol0=cp.oml, ns=cp.ns, kmax=30, prec=1000, window=W_th, camb=False,
-            test=False, Colos=False):
+            test=False, Colos=False, tab=False, mem=None, quad='rect', err=False, tab_prec=None):
     """
     fluctuation rms of smoothed field with a scale R
     :param R: float: smoothing scale
@@ -117,74 +173,264 @@ def sigma_R(R, sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ol0=cp.oml, ns=cp.
     :param window: function : window function for smoothing
     :param camb: boolean : using camb spectrum or analytical approx of eisenstein and hu
     :param test: boolean : used to get out of the recursive loop for the sigma8 normalisation
-    :return: float : fluctuation rms at scale R
+    :param tab: boolean : interpolate in the tabulated sigma(R) of this cosmology instead of integrating. The table is
+    built with quad and mem (see sigma_table)
+    :param mem: int : memory budget in bytes of the integral over k. Default : module value max_mem
+    :param quad: str : quadrature of the k integral. Either 'rect', 'simpson', 'gauss' or 'fftlog'. see sigma_integral
+    and sigma_gauss
+    :param err: boolean : if True also returns an estimate of the absolute integration error on sigma
+    :param tab_prec: int : number of R bins per decade of the table. Default : module value sigma_tab_prec
+    :return: float : fluctuation rms at scale R (, error estimate)
     """
+    scalar = np.ndim(sig8) == np.ndim(h) == np.ndim(omb) == np.ndim(om0) == np.ndim(ol0) == np.ndim(ns) == 0
+    if tab and scalar and not (Colos or test or err):  # one table per cosmology
+        table = sigma_table(float(sig8), float(h), float(omb), float(om0), float(ol0), float(ns), kmax, prec, window,
+                            camb, tab_prec=tab_prec, quad=quad, mem=mem)
+        lR = np.log(R)
+        if np.all((lR >= table.x[0]) & (lR <= table.x[-1])):  # outside of the table we integrate directly
+            res = np.exp(table(lR))
+            return res if np.ndim(R) else float(res)
     if Colos:
-        my_cosmo = {'flat': True, 'H0': 100 * h, 'Om0': om0, 'Ode0': ol0, 'Ob0': omb, 'sigma8': sig8, 'ns': ns}
-        cosmo = cosmology.setCosmology('my_cosmo', my_cosmo)
-        return cosmo.sigma(R, 0.0)
+        return colossus_cosmology(sig8, h, omb, om0, ol0, ns).sigma(R, 0.0)
     else:
         if camb:
             ombh2 = omb * h ** 2
             omch2 = (om0 - omb) * h ** 2
             k, z, pk = camb_power_spectrum(h=h, kmax=kmax, ombh2=ombh2, omch2=omch2, sig8=sig8, npoints=prec,
                                            ns=ns, omk=1 - om0 - ol0, nonlinear=False, linear=True)
-            if type(R) == list or type(R) == np.ndarray:
-                # In units of Mpc/h
-                n = len(R)  # size of Mass imput
-                m = prec  # size of wavenumbers imput
-                Rmat = np.array([R] * m)  # Duplicating the R 1D array to get a n*m size matric
-                kmat = np.array([k] * n).transpose()  # Dupicating the k and pk 1D arrays to get n*m size matrix
-                pkmat = np.array([pk] * n).transpose()
-
-                winres = window(kmat, Rmat)  # Calculating every value of the window function without a boucle
-                dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
-                res = pkmat * kmat ** 3 * winres ** 2  # Values inside the integral foreach k
-                integ = np.sum(res, axis=0) * dlk  # approximate evaluation of the integral through k.
-                return np.sqrt(integ / (2 * np.pi ** 2))
-            else:
-                winres = window(k, R)
-                dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
-                res = pk * k ** 3 * winres ** 2
-                integ = np.sum(res) * dlk
-                return np.sqrt(integ / (2 * np.pi ** 2))
+            if quad == 'gauss':
+                return sigma_gauss(R, interp_power_spectrum(k, pk), np.min(k), np.max(k), window, err=err, mem=mem)
+            return sigma_integral(R, k, pk, window, mem, quad, err)
         else:
+            if quad == 'gauss':  # the power spectrum is only evaluated at the nodes of the quadrature
+                def pk_func(k):
+                    return power_spectrum(k, sig8, h, om0, omb, ns, test)
+                return sigma_gauss(R, pk_func, 1e-7, 1e5, window, err=err, mem=mem)
             prec = 10 * prec  # having more bins is less expensive than in the camb power spectrum case
+            if quad == 'simpson':
+                prec = prec + 1  # Simpson's rule needs an odd number of points
             k = np.logspace(-7, 5, prec)  # creating a k array in log space for the integration
             pk = power_spectrum(k, sig8, h, om0, omb, ns, test)  # corresponding power spectrum values
+            return sigma_integral(R, k, pk, window, mem, quad, err)
 
-            if type(R) == list or type(
-                    R) == np.ndarray:  # for the code to be more robust, we seprate unique R or arrays of R
-                # In units of Mpc/h
-                shp = R.shape  # shape of the Radius matrix
-                n = len(R)  # size of Mass imput
-                m = prec  # size of wavenumbers imput
-                Rmat = np.array([R] * m)  # Duplicating the R 1D array to get a n*m size matrix
-                kt, pkt = k, pk
-                for el in shp:
-                    kt = [kt] * el  # Dupicating the k and pk 1D arrays to get n*m size matrix
-                    pkt = [pkt] * el
 
-                kmat = np.array(kt).transpose()
-                pkmat = np.array(pkt).transpose()
+def _simpson_weights(n, dx):
+    """Weights of the composite Simpson rule on n equally spaced points. The last interval of an even n uses the
+    trapezoidal rule"""
+    m = n if n % 2 else n - 1
+    w = np.zeros(n)
+    w[:m:2] = 2
+    w[1:m:2] = 4
+    w[0] = w[m - 1] = 1
+    w = w * dx / 3
+    if m < n:
+        w[-2:] += dx / 2
+    return w
 
-                winres = window(kmat, Rmat)  # Calculating every value of the window function without a boucle
 
-                dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
-                res = pkmat * kmat ** 3 * winres ** 2  # Values inside the integral foreach k
+def sigma_integral(R, k, pk, window=W_th, mem=None, quad='rect', err=False):
+    """
+    Integration over ln(k) of the power spectrum smoothed at scale R on a log spaced grid of wavenumbers.
+    Arrays of R of any shape are broadcast against k instead of duplicating k and P(k) along every axis, and are
+    processed in blocks so that the (len(k), block) temporaries stay within the memory budget.
+    :param R: float or array of floats: smoothing scale(s) in Mpc/h
+    :param k: array : log spaced wavenumbers in h/Mpc
+    :param pk: array : power spectrum at k
+    :param window: function : window function for smoothing
+    :param mem: int : memory budget in bytes for the temporaries. Default : module value max_mem
+    :param quad: str : 'rect' rectangle rule, 'simpson' Simpson rule in ln(k) or 'fftlog' rectangle rule for all R at
+    once with FFTs (see sigma_fftlog)
+    :param err: boolean : if True also returns the error estimated by comparing with every other wavenumber
+    :return: float or array of the shape of R : fluctuation rms at scale R (, error estimate)
+    """
+    if err:
+        res = sigma_integral(R, k, pk, window, mem, quad)
+        half = sigma_integral(R, k[::2], pk[::2], window, mem, quad)
+        order = 4 if quad == 'simpson' else 1  # Richardson estimate of the error of the full grid
+        return res, np.abs(res - half) / (2 ** order - 1)
+    if quad == 'fftlog':
+        return sigma_fftlog(R, k, pk, window)
+    elif quad == 'simpson':
+        weights = _simpson_weights(len(k), np.log(np.max(k) / np.min(k)) / (len(k) - 1))
+    elif quad == 'rect':
+        weights = None
+    else:
+        raise ValueError("quad should be 'rect', 'simpson', 'gauss' or 'fftlog'")
+    dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
+    if np.ndim(R) == 0:
+        res = pk * k ** 3 * window(k, R) ** 2
+        integ = np.sum(res) * dlk if weights is None else np.dot(weights, res)
+        return np.sqrt(integ / (2 * np.pi ** 2))
+    R = np.asarray(R)
+    Rflat = R.reshape(1, -1)
+    pkk3 = (pk * k ** 3)[:, None]
+    if mem is None:
+        mem = max_mem
+    block = max(1, int(mem // (3 * 8 * len(k))))  # number of R per block, ~3 float64 temporaries of size len(k)
+    integ = np.empty(R.size)
+    for i in range(0, R.size, block):
+        winres = window(k[:, None], Rflat[:, i:i + block])  # (len(k), block) values of the window function
+        res = pkk3 * winres ** 2  # Values inside the integral foreach k
+        if weights is None:
+            integ[i:i + block] = np.sum(res, axis=0) * dlk  # approximate evaluation of the integral through k.
+        else:
+            integ[i:i + block] = np.dot(weights, res)
+    return np.sqrt(integ / (2 * np.pi ** 2)).reshape(R.shape)
 
-                integ = np.sum(res, axis=0) * dlk  # approximate evaluation of the integral through k.
-                return np.sqrt(integ / (2 * np.pi ** 2))
-            else:
-                winres = window(k, R)
-                dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
-                res = pk * k ** 3 * winres ** 2
-                integ = np.sum(res) * dlk
-                return np.sqrt(integ / (2 * np.pi ** 2))
+
+def sigma_fftlog(R, k, pk, window=W_th):
+    """
+    Rectangle rule of sigma_integral for all R at once. The window only depends on kR, so on a grid of R log spaced with
+    the spacing of k, sigma^2(R_j) = sum_i k_i^3 P(k_i) W^2(k_i R_j) is a correlation over ln(k) that FFTs compute in
+    O(N log N). The result is interpolated at the requested R with a cubic spline in ln(R).
+    :param R: float or array of floats: smoothing scale(s) in Mpc/h. Should span less decades than k
+    :param k: array : log spaced wavenumbers in h/Mpc
+    :param pk: array : power spectrum at k
+    :param window: function : window function for smoothing
+    :return: float or array of the shape of R : fluctuation rms at scale R
+    """
+    from scipy.interpolate import CubicSpline
+    n = len(k)
+    dlk = np.log(np.max(k) / np.min(k)) / n  # same normalisation as the rectangle rule
+    d = np.log(k[-1] / k[0]) / (n - 1)  # spacing of the ln(k) grid
+    lR = np.log(R)
+    lRmin = np.min(lR) - 2 * d  # margin of two points for the spline
+    nR = int(np.ceil((np.max(lR) - lRmin) / d)) + 3
+    if nR > n:
+        raise ValueError("The range of R should span less decades than the range of k")
+    f = pk * k ** 3
+    g = window(np.exp(np.log(k[0]) + lRmin + d * np.arange(2 * n - 1)), 1.0) ** 2  # W^2 at k_0 R_0 e^(m d)
+    size = 1 << int(np.ceil(np.log2(3 * n - 2)))  # length of the zero padded FFTs
+    corr = np.fft.irfft(np.fft.rfft(f[::-1], size) * np.fft.rfft(g, size), size)[n - 1:n - 1 + nR]
+    sig = np.sqrt(np.abs(corr) * dlk / (2 * np.pi ** 2))
+    res = np.exp(CubicSpline(lRmin + d * np.arange(nR), np.log(sig))(lR))
+    return res if np.ndim(R) else float(res)
+
+
+def interp_power_spectrum(k, pk):
+    """
+    Log-log linear interpolation of a tabulated power spectrum, zero outside of the table
+    :param k: array : wavenumbers
+    :param pk: array : power spectrum at k
+    :return: function of k
+    """
+    lk, lpk = np.log(k), np.log(pk)
+
+    def pk_func(x):
+        return np.exp(np.interp(np.log(x), lk, lpk, left=-np.inf, right=-np.inf))
+    return pk_func
+
+
+def sigma_gauss(R, pk_func, kmin=1e-7, kmax=1e5, window=W_th, order=8, dlx=0.25, xosc=100, err=False, mem=None):
+    """
+    Gauss-Legendre integration of sigma^2 over x = kR, in segments following the oscillations of the integrand.
+    Up to x = pi/dlx the range is cut in segments of at most dlx in ln(x), short enough for both the baryon wiggles of
+    P(k) and the oscillations of the window. Above, the window oscillates with period ~pi in x and segments are at most
+    pi long in x up to x = xosc. The W^2 ~ x^-4 tail beyond xosc is neglected and only included in the error estimate.
+    The power spectrum is only evaluated at the ~order * (ln(pi/(dlx kmin R))/dlx + xosc/pi) nodes per R.
+    :param R: float or array of floats: smoothing scale(s) in Mpc/h
+    :param pk_func: function : power spectrum as a function of k in h/Mpc
+    :param kmin: float : lower bound of the integral over k
+    :param kmax: float : upper bound of the integral over k
+    :param window: function : window function for smoothing
+    :param order: int : number of Gauss-Legendre nodes per segment
+    :param dlx: float : maximum length in ln(x) of the segments below x = pi/dlx
+    :param xosc: float : kR up to which the oscillations of the window are integrated
+    :param err: boolean : if True also returns the error estimated with order/2 nodes plus the neglected tail
+    :param mem: int : memory budget in bytes for the temporaries. Default : module value max_mem
+    :return: float or array of the shape of R : fluctuation rms at scale R (, error estimate)
+    """
+    Ra = np.asarray(R, dtype=float)
+    Rflat = Ra.ravel()
+    xb = np.pi / dlx  # from there segments of pi in x are shorter than dlx in ln(x)
+    lx0 = np.log(kmin * Rflat)
+    lx1 = np.log(np.minimum(kmax * Rflat, 1))  # x = 1 is an edge, where the k-sharp window is discontinuous
+    lx2 = np.log(np.minimum(kmax * Rflat, xb))  # end of the part integrated over ln(x)
+    x3 = np.maximum(np.minimum(kmax * Rflat, xosc), xb)  # end of the part integrated over x
+    nlog1 = max(1, int(np.ceil(np.max(lx1 - lx0) / dlx)))
+    nlog2 = max(1, int(np.ceil(np.max(lx2 - lx1) / dlx)))
+    nosc = max(1, int(np.ceil(np.max(x3 - xb) / np.pi)))
+    if mem is None:
+        mem = max_mem
+    block = max(1, int(mem // (4 * 8 * (nlog1 + nlog2 + nosc) * order)))
+
+    def segments(start, end, nseg, npts):
+        """Gauss-Legendre nodes (nseg, npts, b) and half lengths (nseg, b) of nseg equal segments per R"""
+        nodes, weights = np.polynomial.legendre.leggauss(npts)
+        edges = start + (end - start) * np.arange(nseg + 1)[:, None] / nseg
+        half = 0.5 * (edges[1:] - edges[:-1])
+        return (0.5 * (edges[1:] + edges[:-1]))[:, None, :] + half[:, None, :] * nodes[None, :, None], \
+            half[:, None, :] * weights[None, :, None]
+
+    def integrate(npts):
+        integ = np.empty(Rflat.size)
+        tail = np.empty(Rflat.size)
+        for i in range(0, Rflat.size, block):
+            r = Rflat[i:i + block]
+            integ[i:i + block] = 0
+            for start, end, nseg in [(lx0, lx1, nlog1), (lx1, lx2, nlog2)]:  # integral over ln(x)
+                lx, wts = segments(start[i:i + block], end[i:i + block], nseg, npts)
+                x = np.exp(lx)
+                integ[i:i + block] += np.sum(wts * pk_func(x / r) * x ** 3 / r ** 3 * window(x, 1.0) ** 2, axis=(0, 1))
+            x, wts = segments(xb, x3[i:i + block], nosc, npts)  # integral over x, divided by x
+            seg = np.sum(wts * pk_func(x / r) * x ** 2 / r ** 3 * window(x, 1.0) ** 2, axis=1)
+            integ[i:i + block] += np.sum(seg, axis=0)
+            mean = seg[-1] / np.maximum(x3[i:i + block] - xb, 1e-300) * nosc  # mean integrand on the last segment
+            tail[i:i + block] = mean * x3[i:i + block] / 2  # integral of the x^-5 envelope, twice the mean
+        return np.sqrt(integ / (2 * np.pi ** 2)), tail / (2 * np.pi ** 2)
+
+    res, tail = integrate(order)
+    if err:
+        low, _ = integrate(max(1, order // 2))
+        tail = np.where(kmax * Rflat > xosc, tail, 0)
+        error = np.abs(res - low) + tail / (2 * res)  # error on sigma from the error on sigma^2
+        if np.ndim(R):
+            return res.reshape(Ra.shape), error.reshape(Ra.shape)
+        return float(res[0]), float(error[0])
+    return res.reshape(Ra.shape) if np.ndim(R) else float(res[0])
+
+
+def sigma_table(sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ol0=cp.oml, ns=cp.ns, kmax=30, prec=1000, window=W_th,
+                camb=False, lRmin=-6, lRmax=3, tab_prec=None, quad='rect', mem=None):
+    """
+    Cubic spline of ln(sigma) as a function of ln(R) for one cosmology. The table is integrated once and kept in memory,
+    up to max_sigma_tables cosmologies are stored and the least recently used one is dropped first.
+    :param sig8: float: sigma 8 cosmological parameter
+    :param h: float : H0/100 cosmo parameter
+    :param omb: float : baryon fraction density
+    :param om0: float : matter fraction density
+    :param ol0: float : dark energy fraction density
+    :param ns: float : initial power spectrum power law index
+    :param kmax: float : maximum wavenumber to get power spectrum. default : 30. useful for camb spectrum
+    :param prec: float : number of bins of k or integral
+    :param window: function : window function for smoothing
+    :param camb: boolean : using camb spectrum or analytical approx of eisenstein and hu
+    :param lRmin: float : log10 of the smallest tabulated R in Mpc/h
+    :param lRmax: float : log10 of the largest tabulated R in Mpc/h
+    :param tab_prec: int : number of R bins per decade. Controls the accuracy of the interpolation. Default : module
+    value sigma_tab_prec
+    :param quad: str : quadrature of the k integral used to build the table, see sigma_R. One table per quadrature
+    :param mem: int : memory budget in bytes of the integral while building the table. Default : module value max_mem
+    :return: scipy.interpolate.CubicSpline : ln(sigma) as a function of ln(R)
+    """
+    if tab_prec is None:
+        tab_prec = sigma_tab_prec
+    key = (sig8, h, omb, om0, ol0, ns, kmax, prec, window, camb, lRmin, lRmax, tab_prec, quad)
+    if key in _sigma_tables:
+        _sigma_tables.move_to_end(key)
+        return _sigma_tables[key]
+    from scipy.interpolate import CubicSpline
+    R = np.logspace(lRmin, lRmax, int((lRmax - lRmin) * tab_prec) + 1)
+    table = CubicSpline(np.log(R), np.log(sigma_R(R, sig8, h, omb, om0, ol0, ns, kmax, prec, window, camb, mem=mem,
+                                                  quad=quad)))
+    _sigma_tables[key] = table
+    if len(_sigma_tables) > max_sigma_tables:
+        _sigma_tables.popitem(last=False)
+    return table
 
 
 def sigma(x, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', xin='M', prec=1000, om0=cp.om, ol0=cp.oml, omb=cp.omb,
-          camb=False, Colos=False, ns=cp.ns):
+          camb=False, Colos=False, ns=cp.ns, tab=False, mem=None, quad='rect', err=False, tab_prec=None):
     """
     fluctuation rms of smoothed field with a scale R or of a mass M
     :param x : float: either M mass in Msun/h or smoothin scale R in Mpc/h
@@ -199,31 +445,45 @@ def sigma(x, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', xin='M', prec=100
     :param prec: float : number of bins of k or integral
     :param window: function : window function for smoothing
     :param camb: boolean : using camb spectrum or analytical approx of eisenstein and hu
-    :param test: boolean : used to get out of the recursive loop for the sigma8 normalisation
+    :param tab: boolean : interpolate in the tabulated sigma(R) of this cosmology instead of integrating. The table is
+    built with quad and mem
+    :param mem: int : memory budget in bytes of the integral over k. Default : module value max_mem
+    :param quad: str : quadrature of the k integral. Either 'rect', 'simpson', 'gauss' or 'fftlog'
+    :param err: boolean : if True also returns an estimate of the absolute integration error
+    :param tab_prec: int : number of R bins per decade of the table. Default : module value sigma_tab_prec
     :return: float : fluctuation rms at scale R or at mass M
     """
 
     if xin == 'R':
         if window == 'TopHat':
-            return sigma_R(x, sig8, h, omb, om0, ol0, ns, kmax, prec, W_th, camb, Colos=Colos)
+            return sigma_R(x, sig8, h, omb, om0, ol0, ns, kmax, prec, W_th, camb, Colos=Colos, tab=tab, mem=mem,
+                           quad=quad, err=err, tab_prec=tab_prec)
         elif window == 'Gauss':
-            return sigma_R(x, sig8, h, omb, om0, ol0, ns, kmax, prec, W_gauss, camb, Colos=Colos)
+            return sigma_R(x, sig8, h, omb, om0, ol0, ns, kmax, prec, W_gauss, camb, Colos=Colos, tab=tab, mem=mem,
+                           quad=quad, err=err, tab_prec=tab_prec)
         elif window == 'k-Sharp':
-            return sigma_R(x, sig8, h, omb, om0, ol0, ns, kmax, prec, W_ksharp, camb, Colos=Colos)
+            return sigma_R(x, sig8, h, omb, om0, ol0, ns, kmax, prec, W_ksharp, camb, Colos=Colos, tab=tab, mem=mem,
+                           quad=quad, err=err, tab_prec=tab_prec)
     elif xin == 'M':
         if window == 'TopHat':
             R = (3 * x / (4 * np.pi * cp.rho_m(0, om0))) ** (1 / 3)
-            return sigma_R(R, sig8, h, omb, om0, ol0, ns, kmax, prec, W_th, camb, Colos=Colos)
+            return sigma_R(R, sig8, h, omb, om0, ol0, ns, kmax, prec, W_th, camb, Colos=Colos, tab=tab, mem=mem,
+                           quad=quad, err=err, tab_prec=tab_prec)
         elif window == 'Gauss':
             R = (x / cp.rho_m(0, om0)) ** (1 / 3) / np.sqrt(np.pi)
-            return sigma_R(R, sig8, h, omb, om0, ol0, ns, kmax, prec, W_gauss, camb, Colos=Colos)
+            return sigma_R(R, sig8, h, omb, om0, ol0, ns, kmax, prec, W_gauss, camb, Colos=Colos, tab=tab, mem=mem,
+                           quad=quad, err=err, tab_prec=tab_prec)
         elif window == 'k-Sharp':
             R = (x / (6 * np.pi ** 2 * cp.rho_m(0, om0))) ** (1 / 3)
-            return sigma_R(R, sig8, h, omb, om0, ol0, ns, kmax, prec, W_ksharp, camb, Colos=Colos)
+            return sigma_R(R, sig8, h, omb, om0, ol0, ns, kmax, prec, W_ksharp, camb, Colos=Colos, tab=tab, mem=mem,
+                           quad=quad, err=err, tab_prec=tab_prec)
 
 
 
 if __name__ == "__main__":
+    from colossus.cosmology import cosmology
+
+    cosmo = cosmology.setCosmology('planck15')
     #############################-------------------Comparison with Colossus-----------------###############################
 
 
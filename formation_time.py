@@ -1,8 +1,8 @@
 import numpy as np
 import cosmo_parameters as cp
+import fluctuation_rms as fm
 from fluctuation_rms import sigma
 from halo_mass_function import fps
-from autograd import grad
 from math import factorial
 
 
@@ -92,11 +92,59 @@ def f_sc(S1, S0, w1, w0):
     return (2 * np.pi) ** -0.5 * dw * ds ** (-1.5) * np.exp(-0.5 * dw ** 2 / ds)  # lacey&cole multiplicity function
 
 
+def f_mb(S1, S0, w1, w0, alpha=0.615, beta=0.485, a=0.7, order=3):
+    """
+    Moving barrier multiplicity function of Sheth & Tormen (2002), with the Taylor series of the barrier truncated at
+    order. The derivatives of the power law barrier are analytic (see barrier_series), so any shape of arrays is
+    computed at once.
+    :param S1: float or array sigma(M1) where M1 is the initial mass
+    :param S0: float sigma(M0) where M0 is the descendant mass
+    :param w1: float or array delta_c(z1) where z1 is the initial redshift
+    :param w0: float delta_c(z0) where z0 is the final redshift
+    :param alpha: float barrier exponent
+    :param beta: float barrier amplitude
+    :param a: float barrier normalisation
+    :param order: int number of terms of the Taylor series
+    :return: value of the moving barrier multiplicity function
+    """
+    dS = S1 - S0
+    b0 = Barrier(S0, w0, alpha, beta, a)
+    dB = b0 - Barrier(S1, w1, alpha, beta, a)
+    T = b0 - barrier_series(S1, S0, w1, alpha, beta, a, order)
+    return np.abs(T) * np.exp(-0.5 * dB ** 2 / dS) / (np.sqrt(2 * np.pi) * dS ** 1.5)
+
+
 def Barrier(s, delta, alpha, beta, a):
     return np.sqrt(a) * delta * (1 + beta * s ** alpha / (a * delta ** 2) ** alpha)
 
 
+def barrier_series(s, x0, delta, alpha=0.615, beta=0.485, a=0.7, order=3):
+    """
+    Taylor series of the moving barrier B(s) = sqrt(a) delta (1 + beta s^alpha / (a delta^2)^alpha) around s evaluated
+    at x0, sum over j < order of (x0-s)^j B^(j)(s) / j!. The derivatives are exact for the power law, the j-th term is
+    the previous one times (x0-s)/s (alpha-j+1)/j, updated in place in a single buffer.
+    :param s: float or array variance around which the barrier is expanded
+    :param x0: float or array variance at which the series is evaluated
+    :param delta: float or array critical overdensity
+    :param alpha: float barrier exponent
+    :param beta: float barrier amplitude
+    :param a: float barrier normalisation
+    :param order: int number of terms
+    :return: float or array
+    """
+    ratio = (x0 - s) / s
+    term = np.sqrt(a) * delta * beta * (a * delta ** 2) ** (-alpha) * s ** alpha  # moving part of B(s)
+    term = np.array(np.broadcast_to(term, np.broadcast(term, ratio).shape), dtype=float)
+    res = np.sqrt(a) * delta + term
+    for j in range(1, order):
+        np.multiply(term, ratio, out=term)
+        term *= (alpha - j + 1) / j
+        res += term
+    return res[()]
+
+
 def my_grad(fun, order):
+    from autograd import grad
     for i in range(order):
         fun = grad(fun)
     return fun
@@ -121,7 +169,8 @@ def ngTaylor(s, x0, dB, order, axis=0):
 
 
 def proba(M, zf, frac=0.5, acc=1000, zi=0.0, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=300, om0=cp.om,
-          ol0=cp.oml, omb=cp.omb, camb=False, model='EC', colos=False, alpha=0.615, beta=0.485, a=0.7, order=3):
+          ol0=cp.oml, omb=cp.omb, camb=False, model='EC', colos=False, alpha=0.615, beta=0.485, a=0.7, order=3,
+          tab=True, tab_prec=None):
     """
      Probability density of a halo of mass M at redshift zi has had a fraction frac of its mass at z=zf.
      :param M: float. mass of the halo considered
@@ -140,18 +189,21 @@ def proba(M, zf, frac=0.5, acc=1000, zi=0.0, sig8=cp.sigma8, h=cp.h, kmax=30, wi
      :param camb:  boolean : if using camb spectrum or analytical version of Eisenstein and Hu.
      :param model: if Press&Schechter mass function "press" or ellipsoidal collapse "EC"
      :param colos: :param Colos : boolan : using Colossus halo mass function or not
+     :param tab: bool : use the shared sigma(R) table of the cosmology (see fluctuation_rms.sigma_table)
+     :param tab_prec: int : number of R bins per decade of the sigma(R) table. Default : fluctuation_rms.sigma_tab_prec
      :return: Probability density function of redshift at which halos had x fraction of their mass
      """
-    S0 = sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos) ** 2  # variance of the field at mass M
+    S0 = sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos, tab=tab,
+               tab_prec=tab_prec) ** 2  # variance of the field at mass M
     w0 = cp.delta_c(zi, om0, ol0)  # critical density at observed redshift
     if type(zf) == np.ndarray:  # for probability distribution. This is to have a parallel version with no for loops
         mass = np.logspace(np.log10(M * frac), np.log10(M), acc)  # size (0, acc) masses to calculate the integral
         l = len(zf)  # number of steps in PDF
-        mat_zf = np.array([zf] * acc)  # (acc, l)
         mat_mass = np.array([mass] * l).transpose()  # duplicating mass array to vectoralize calculations (acc, l)
-        mat_wf = cp.delta_c(mat_zf, om0, ol0) - w0  # (acc, l)
-        mat_S = sigma(mat_mass, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb,
-                      colos) ** 2 - S0  # variance difference of all masses (acc, l)
+        mat_wf = np.array([cp.delta_c(zf, om0, ol0) - w0] * acc)  # (acc, l) delta_c computed once per redshift
+        S = sigma(mass, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos, tab=tab,
+                  tab_prec=tab_prec) ** 2 - S0  # (acc, ) once per mass
+        mat_S = np.array([S] * l).transpose()  # variance difference of all masses (acc, l)
         mat_S[-1, :] = 1e-10  # nonzero value to avoid numerical effects
         mat_nu = mat_wf / np.sqrt(mat_S)  # (acc, l) peak height
         if model == 'EC':  # Ellipsoidal collapse probability density function
@@ -160,12 +212,8 @@ def proba(M, zf, frac=0.5, acc=1000, zi=0.0, sig8=cp.sigma8, h=cp.h, kmax=30, wi
             mat_ds = 0.5 * (mat_S[2:, :] - mat_S[:-2, :])  # differential to use to integrate over
             return -M * np.sum(mat_ds * mat_f[1:-1, :] / mat_mass[1:-1, :], axis=0)
         elif model == 'sheth2002':
-            b1 = Barrier(mat_S + S0, mat_wf + w0, alpha, beta, a)
-            b2 = Barrier(S0, w0, alpha, beta, a)
-            dB = b2 - b1
-            T1 = np.abs(ngTaylor(mat_S + S0, S0, dB, axis=0, order=order))
-            gradS = np.gradient(mat_S + S0, axis=0, edge_order=2)
-            mat_f = T1 * np.exp(-0.5 * dB ** 2 / mat_S) / (np.sqrt(2 * np.pi) * mat_S ** 1.5)
+            mat_f = f_mb(mat_S + S0, S0, mat_wf + w0, w0, alpha, beta, a, order)
+            gradS = np.gradient(mat_S, axis=0, edge_order=2)
             return -M * np.sum(gradS * mat_f / mat_mass, axis=0)
         else:
             mat_f = fps(mat_nu[:-1, :]) / mat_nu[:-1, :]  # (acc-1, l) # Press & Schechter multiplicity function
@@ -174,7 +222,8 @@ def proba(M, zf, frac=0.5, acc=1000, zi=0.0, sig8=cp.sigma8, h=cp.h, kmax=30, wi
     else:  # case of only one value of redshift to get the probability distribution of.
         mass = np.logspace(np.log10(M * frac), np.log10(M), acc)
         wf = cp.delta_c(zf, om0, ol0) - w0
-        S = sigma(mass, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos) ** 2 - S0
+        S = sigma(mass, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos, tab=tab,
+                  tab_prec=tab_prec) ** 2 - S0
         S[-1] = 1e-10
         nu = wf / np.sqrt(S)
         if model == 'EC':
@@ -183,77 +232,246 @@ def proba(M, zf, frac=0.5, acc=1000, zi=0.0, sig8=cp.sigma8, h=cp.h, kmax=30, wi
             return -M * np.sum(ds * f[1:-1] / mass[1:-1])
 
         elif model == 'sheth2002':
-            f = np.zeros((acc, 1))
-            for i in range(acc):
-                b1 = Barrier(S[i] + S0, wf[i] + w0, alpha, beta, a)
-                b2 = Barrier(S0, w0, alpha, beta, a)
-                dB = b2 - b1
-                T1 = np.abs(ngTaylor(S[i] + S0, S0, dB, order=order))
-                f[i] = T1 * np.exp(-0.5 * (b1 - b2) ** 2 / S[i]) / (np.sqrt(2 * np.pi) * S[i] ** 1.5)
-            ds = 0.5 * (S[2:] - S[:-2])
-            return -M * np.sum(ds * f[1:-1] / mass[1:-1])
+            f = f_mb(S + S0, S0, wf + w0, w0, alpha, beta, a, order)
+            gradS = np.gradient(S, edge_order=2)  # same quadrature as the array version
+            return -M * np.sum(gradS * f / mass)
         else:
             f = fps(nu) / nu
             dnu = (nu[2:] - nu[:-2]) * 0.5
             return M * np.sum(dnu * f[1:-1] / mass[1:-1])
 
 
+def proba_grid(M, zf, frac=0.5, acc=1000, zi=0.0, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=300,
+               om0=cp.om, ol0=cp.oml, omb=cp.omb, camb=False, model='EC', colos=False, alpha=0.615, beta=0.485, a=0.7,
+               order=3, tab=True, mem=None, tab_prec=None):
+    """
+    Cumulative probability P(z_f > zf) of proba for an array of halo masses at once, on a (n_M, n_z) grid. sigma is
+    evaluated in a single call for all the masses, interpolated in the tabulated sigma(R) of the cosmology if tab.
+    :param M: float or ndarray (n_M, ). masses of the halos considered
+    :param zf: ndarray (n_z, ) redshifts shared by all the masses, or (n_M, n_z) one set of redshifts per mass
+    :param tab: bool : use the shared sigma(R) table of the cosmology (see fluctuation_rms.sigma_table)
+    :param mem: int : memory budget in bytes of the temporaries. Default : fluctuation_rms.max_mem
+    :param tab_prec: int : number of R bins per decade of the sigma(R) table. Default : fluctuation_rms.sigma_tab_prec
+    See proba() for the other parameters
+    :return: ndarray (n_M, n_z) probabilities
+    """
+    if mem is None:
+        mem = fm.max_mem
+    M = np.atleast_1d(M).astype(float)
+    zf = np.atleast_1d(zf)
+    nm, nz = len(M), zf.shape[-1]
+    S0 = sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos, tab=tab,
+               tab_prec=tab_prec) ** 2  # (n_M, )
+    w0 = cp.delta_c(zi, om0, ol0)
+    steps = np.linspace(np.log10(frac), 0, acc)
+    mass = M[:, None] * 10 ** steps  # (n_M, acc) same steps as np.logspace(log10(M*frac), log10(M), acc)
+    S = sigma(mass, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos, tab=tab,
+              tab_prec=tab_prec) ** 2 - S0[:, None]
+    S[:, -1] = 1e-10  # nonzero value to avoid numerical effects
+    wf = (cp.delta_c(zf, om0, ol0) - w0).reshape(-1, 1, nz)  # (1 or n_M, 1, n_z)
+    res = np.empty((nm, nz))
+    block = max(1, int(mem // (8 * 8 * acc * nz)))  # about 8 temporaries of size (block, acc, n_z)
+    for i in range(0, nm, block):
+        sl = slice(i, i + block)
+        mat_S = S[sl, :, None]  # (block, acc, 1)
+        mat_mass = mass[sl, :, None]
+        s0 = S0[sl, None, None]
+        mat_wf = wf if wf.shape[0] == 1 else wf[sl]
+        if model == 'EC':
+            mat_f = f_ec(mat_S + s0, s0, mat_wf + w0, w0)
+            mat_ds = 0.5 * (mat_S[:, 2:] - mat_S[:, :-2])
+            res[sl] = -M[sl, None] * np.sum(mat_ds * mat_f[:, 1:-1] / mat_mass[:, 1:-1], axis=1)
+        elif model == 'sheth2002':
+            mat_f = f_mb(mat_S + s0, s0, mat_wf + w0, w0, alpha, beta, a, order)
+            gradS = np.gradient(mat_S, axis=1, edge_order=2)
+            res[sl] = -M[sl, None] * np.sum(gradS * mat_f / mat_mass, axis=1)
+        else:
+            mat_nu = mat_wf / np.sqrt(mat_S)
+            mat_f = fps(mat_nu[:, :-1]) / mat_nu[:, :-1]
+            mat_dnu = (mat_nu[:, 2:-1] - mat_nu[:, :-3]) * 0.5
+            res[sl] = M[sl, None] * np.sum(mat_dnu * mat_f[:, 1:-1] / mat_mass[:, 1:-2], axis=1)
+    return res
+
+
+def _integ_worker(task):
+    """Weighted sum over one chunk of halos of M_integ_proba. Defined at module level to be sent to the workers"""
+    masses, weights, zf, args = task
+    res = proba_grid(masses, zf, *args)
+    if weights is None:
+        return np.sum(res, axis=0)
+    return np.dot(weights, res)
+
+
+def _integ_init(args):
+    """Builds the sigma(R) table of the cosmology in a worker, a no-op when it was inherited from the parent"""
+    frac, acc, zi, sig8, h, kmax, window, prec, om0, ol0, omb, camb, model, colos = args
+    sigma(1e12, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos, tab=True)
+
+
+def tree_sum(partials):
+    """
+    Pairwise sum of a stream of arrays, holding at most log2(n) partial sums at once
+    :param partials: iterable of arrays of the same shape
+    :return: array : sum of the arrays
+    """
+    stack = []  # (number of arrays summed, partial sum), sizes decreasing from the bottom
+    for el in partials:
+        n = 1
+        while stack and stack[-1][0] == n:
+            m, prev = stack.pop()
+            el = prev + el
+            n += m
+        stack.append((n, el))
+    res = stack.pop()[1]
+    while stack:
+        res = stack.pop()[1] + res
+    return res
+
+
 def M_integ_proba(masses, weights=None, zf=np.linspace(0, 7, 20), frac=0.5, acc=1000, zi=0.0, sig8=cp.sigma8, h=cp.h,
                   kmax=30, window='TopHat', prec=1000, om0=cp.om, diff=False,
-                  ol0=cp.oml, omb=cp.omb, camb=False, model='EC', colos=False):
+                  ol0=cp.oml, omb=cp.omb, camb=False, model='EC', colos=False, processes=None, chunk=1000,
+                  dlogm=None, rtol=None, err=False, atol=0):
     """
-    Mass weighted cummulative probability of zf
+    Mass weighted cummulative probability of zf. The catalogue is split in chunks of halos computed with proba_grid by
+    the workers of a process pool, which all use the sigma(R) table built once in the parent. The sums of the chunks
+    are reduced pairwise as they arrive, so the per halo probabilities are never all held in memory.
+    If dlogm or rtol is given, the probability is instead computed on a grid of log10(M) nodes and linearly interpolated
+    at the mass of each halo (see binned_proba), which costs one proba per node whatever the size of the catalogue.
     :param masses: list or np.array masses of halos to get the average zf
     :param weights: list, array or None  weights of the masses
     :param zf: float or array redshifts where to give probability
+    :param processes: int : number of worker processes. Default : number of cpus. 1 runs serially
+    :param chunk: int : number of halos per task
+    :param dlogm: float : spacing in log10(M) of the nodes of the binned mode
+    :param rtol: float : relative error target of the binned mode at each zf, the nodes are refined until it is reached
+    :param atol: float : absolute error floor of the binned mode, for the zf where the probability vanishes
+    :param err: bool : if True also returns the estimated error of the binned mode (0 when computed halo per halo)
     See proba() function for the rest of the parameters
     :return:
     """
-    res = []
-    if not (type(weights) == np.ndarray or type(weights) == list):
-        for mass in masses:
-            if diff:
-                prob = proba(mass, zf, frac, acc, zi, sig8, h, kmax, window, prec, om0, ol0, omb, camb,
-                             model, colos)
-                dz = zf[2:] - zf[:-2]
-                res.append((prob[2:] - prob[:-2]) / dz)
-            else:
-                res.append(proba(mass, zf, frac, acc, zi, sig8, h, kmax, window, prec, om0, ol0, omb, camb,
-                                 model, colos))
-        ares = np.array(res)
-        return np.sum(ares, axis=0) / len(masses)
+    masses = np.asarray(masses, dtype=float)
+    if type(weights) == np.ndarray or type(weights) == list:
+        weights = np.asarray(weights, dtype=float) / np.sum(weights)
+    else:
+        weights = None
+    args = (frac, acc, zi, sig8, h, kmax, window, prec, om0, ol0, omb, camb, model, colos)
+    if dlogm is not None or rtol is not None:
+        res, error = binned_proba(masses, weights, zf, args, 0.1 if dlogm is None else dlogm, rtol, atol)
     else:
-        for i in range(len(masses)):
-            mass = masses[i]
-            w = weights[i] / np.sum(weights)
-            if diff:
-                prob = proba(mass, zf, frac, acc, zi, sig8, h, kmax, window, prec, om0, ol0, omb, camb,
-                             model, colos)
-                dz = zf[2:] - zf[:-2]
-                res.append(-(prob[2:] - prob[:-2]) * w / dz)
-            else:
-                res.append(proba(mass, zf, frac, acc, zi, sig8, h, kmax, window, prec, om0, ol0, omb, camb,
-                                 model, colos) * w)
-        ares = np.array(res)
-        return np.sum(ares, axis=0)
-
-
-def median_formation(M, z, frac=0.5, acc=100, nzeds=10000, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=1000,
-                     om0=cp.om, ol0=cp.oml, omb=cp.omb, model='EC', camb=False, colos=True, outc=False):
+        tasks = ((masses[i:i + chunk], None if weights is None else weights[i:i + chunk], zf, args)
+                 for i in range(0, len(masses), chunk))
+        _integ_init(args)  # the table is inherited by forked workers
+        if processes == 1 or len(masses) <= chunk:
+            res = tree_sum(map(_integ_worker, tasks))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=processes, initializer=_integ_init, initargs=(args,)) as executor:
+                res = tree_sum(executor.map(_integ_worker, tasks))
+        error = np.zeros_like(res)
+    if weights is None:
+        res, error = res / len(masses), error / len(masses)
+    if np.ndim(zf) == 0:
+        res, error = res[0], error[0]
+    elif diff:  # derivative of the sum, equal to the sum of the derivatives
+        dz = zf[2:] - zf[:-2]
+        res = (res[2:] - res[:-2]) / dz * (1 if weights is None else -1)
+        error = (error[2:] + error[:-2]) / dz
+    if err:
+        return res, error
+    return res
+
+
+def _node_weights(lm, w, lmin, dl, n):
     """
-    Calculates the median formation redshift of halos of mass M at redshift z, and gets the concentration if needed    :param M: float M
+    Linear interpolation weights of nodes lmin + dl * arange(n + 1) summed over the log masses lm
+    :return: ndarray (n + 1, )
+    """
+    t = (lm - lmin) / dl
+    i = np.minimum(t.astype(int), n - 1)
+    t = t - i
+    return np.bincount(i, w * (1 - t), n + 1) + np.bincount(i + 1, w * t, n + 1)
+
+
+def binned_proba(masses, weights, zf, args, dlogm=0.1, rtol=None, atol=0):
+    """
+    Weighted sum over halos of proba, with the probability interpolated linearly in log10(M) between nodes. The error is
+    estimated by comparison with the interpolation between every other node, which is 4 times less accurate. With
+    rtol, the number of nodes is doubled until the estimated error is below atol + rtol times the result at every zf,
+    or until there are as many nodes as halos.
+    :param masses: ndarray masses of the halos
+    :param weights: ndarray or None : weights of the halos, None for 1 each
+    :param zf: float or array redshifts where to give probability
+    :param args: tuple : arguments of proba_grid after zf
+    :param dlogm: float : maximum spacing of the nodes in log10(M)
+    :param rtol: float or None : relative error target at each zf
+    :param atol: float : absolute error floor, in units of the weighted sum
+    :return: (ndarray, ndarray) : weighted sum of the probabilities over the halos and its estimated absolute error
+    """
+    lm = np.log10(masses)
+    w = np.ones(len(lm)) if weights is None else weights
+    lmin = np.min(lm)
+    n = 2 * max(1, int(np.ceil((np.max(lm) - lmin) / (2 * dlogm))))  # even to compare with every other node
+    dl = max(np.max(lm) - lmin, dlogm) / n
+    probs = proba_grid(10 ** (lmin + dl * np.arange(n + 1)), zf, *args)  # (n + 1, n_z)
+    while True:
+        res = np.dot(_node_weights(lm, w, lmin, dl, n), probs)
+        coarse = np.dot(_node_weights(lm, w, lmin, 2 * dl, n // 2), probs[::2])
+        error = np.abs(res - coarse) / 3
+        if rtol is None or not np.any(error > atol + rtol * np.abs(res)) or n >= len(lm):  # nan where zf = zi
+            return res, error
+        mid = proba_grid(10 ** (lmin + dl * (np.arange(n) + 0.5)), zf, *args)
+        probs = np.insert(probs, np.arange(1, n + 1), mid, axis=0)  # nodes and midpoints interleaved
+        n, dl = 2 * n, dl / 2
+
+
+def median_formation(M, z, frac=0.5, acc=100, nzeds=60, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=1000,
+                     om0=cp.om, ol0=cp.oml, omb=cp.omb, model='EC', camb=False, colos=True, outc=False, xtol=1e-4):
+    """
+    Calculates the median formation redshift of halos of mass M at redshift z, and gets the concentration if needed.
+    P(z_f > z) is evaluated once on a coarse grid with the array version of proba, then the crossing of 0.5 is refined
+    with Brent's method. For an array of masses, the grid is computed for all masses at once with proba_grid and the
+    crossings are refined by a bisection common to all masses.
+    :param M: float or array of masses
     :param z: float redshift
+    :param nzeds: int number of redshifts of the coarse grid between z+0.1 and z+6
     :param outc: bool if True outputs concentration parameter estimation
-    :return: float : z50 or c(z50)
+    :param xtol: float absolute tolerance on z50
+    :return: float or array : z50 or c(z50)
     """
-    if type(M) == list or type(M) == np.ndarray:
-        raise TypeError("M should not be an array")
     zs = np.linspace(z + 0.1, 6 + z, nzeds)
-    res = []
-    for red in zs:
-        res.append(proba(M, red, frac, acc, z, sig8, h, kmax, window, prec, om0, ol0, omb, camb, model, colos))
-    res = np.array(res)
-    zf = np.max(zs[res > 0.5])
+    if type(M) == list or type(M) == np.ndarray:
+        def cumul(red):
+            return proba_grid(M, red, frac, acc, z, sig8, h, kmax, window, prec, om0, ol0, omb, camb, model, colos)
+
+        res = cumul(zs)  # (n_M, nzeds)
+        above = res > 0.5
+        if not np.all(np.any(above, axis=1)):
+            raise ValueError("P(z_f > z) is below 0.5 from z+0.1 for some masses")
+        i = nzeds - 1 - np.argmax(above[:, ::-1], axis=1)  # last redshift of the grid with P(z_f > z) > 0.5
+        lower, upper = zs[i], zs[np.minimum(i + 1, nzeds - 1)]
+        while np.max(upper - lower) > xtol:
+            mid = 0.5 * (lower + upper)
+            above = cumul(mid[:, None])[:, 0] > 0.5
+            lower = np.where(above, mid, lower)
+            upper = np.where(above, upper, mid)
+        zf = 0.5 * (lower + upper)
+    else:
+        from scipy.optimize import brentq
+
+        def cumul(red):
+            return proba(M, np.atleast_1d(red), frac, acc, z, sig8, h, kmax, window, prec, om0, ol0, omb, camb, model,
+                         colos)
+
+        res = cumul(zs)
+        above = np.nonzero(res > 0.5)[0]
+        if len(above) == 0:
+            raise ValueError("P(z_f > z) is below 0.5 from z+0.1")
+        i = above[-1]  # last redshift of the grid with P(z_f > z) > 0.5
+        if i == nzeds - 1:
+            zf = zs[-1]
+        else:
+            zf = brentq(lambda red: cumul(red)[0] - 0.5, zs[i], zs[i + 1], xtol=xtol)
     if outc:
         return 0.7 + 0.77 * np.log10(zf)
     else:
@@ -262,20 +480,19 @@ def median_formation(M, z, frac=0.5, acc=100, nzeds=10000, sig8=cp.sigma8, h=cp.
 
 def average_formation(M, z, frac=0.5, acc=100, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=1000,
                       om0=cp.om, ol0=cp.oml, omb=cp.omb, camb=False, colos=True, outc=False):
-    # Gets the average z50 of a population of halos at mass M and redshift z
-    if type(M) == list or type(M) == np.ndarray:
-        raise TypeError("M should not be an array")
-
-    zs = np.linspace(z + 1.2 * sig8 / (2.7 + 0.2 * np.log10(M) + 0.1 * om0), z + 8, acc)
-    res = []
-    for red in zs:
-        res.append(proba(M, red, frac, acc, z, sig8, h, kmax, window, prec, om0, ol0, omb, camb, 'EC', colos))
-    res = np.array(res)
-    dens = (res[2:] - res[:-2]) / (zs[2:] - zs[:-2])
-    dz = zs[1] - zs[0]
-    lower = -dz * np.sum(zs[1:-1] * dens)
-    deltap = (zs[0] - z) * dens[0]
+    # Gets the average z50 of a population of halos at mass M and redshift z. M can be an array of masses.
+    vect = type(M) == list or type(M) == np.ndarray
+    M = np.atleast_1d(M).astype(float)
+    zmin = z + 1.2 * sig8 / (2.7 + 0.2 * np.log10(M) + 0.1 * om0)  # (n_M, ) lower redshift of each mass
+    zs = zmin[:, None] + (z + 8 - zmin[:, None]) * np.linspace(0, 1, acc)  # (n_M, acc)
+    res = proba_grid(M, zs, frac, acc, z, sig8, h, kmax, window, prec, om0, ol0, omb, camb, 'EC', colos)
+    dens = (res[:, 2:] - res[:, :-2]) / (zs[:, 2:] - zs[:, :-2])
+    dz = zs[:, 1] - zs[:, 0]
+    lower = -dz * np.sum(zs[:, 1:-1] * dens, axis=1)
+    deltap = (zs[:, 0] - z) * dens[:, 0]
     upper = lower - deltap
+    if not vect:
+        lower, upper = lower[0], upper[0]
     if outc:
         return 0.7 + 0.77 * np.log10(lower)
     else:
@@ -284,18 +501,14 @@ def average_formation(M, z, frac=0.5, acc=100, sig8=cp.sigma8, h=cp.h, kmax=30,
 
 def peak_formation(M, z, frac=0.5, acc=100, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=1000,
                    om0=cp.om, ol0=cp.oml, omb=cp.omb, camb=False, colos=True, outc=False):
-    # Gets the redshift at which the z50 probability distribution peaks
-
-    if type(M) == list or type(M) == np.ndarray:
-        raise TypeError("M should not be an array")
-
+    # Gets the redshift at which the z50 probability distribution peaks. M can be an array of masses.
+    vect = type(M) == list or type(M) == np.ndarray
     zs = np.linspace(z + 0.1, z + 6, acc)
-    res = []
-    for red in zs:
-        res.append(proba(M, red, frac, acc, z, sig8, h, kmax, window, prec, om0, ol0, omb, camb, 'EC', colos))
-    res = np.array(res)
-    dens = -(res[2:] - res[:-2]) / (zs[2:] - zs[:-2])
-    zf = zs[np.argmax(dens)]
+    res = proba_grid(M, zs, frac, acc, z, sig8, h, kmax, window, prec, om0, ol0, omb, camb, 'EC', colos)
+    dens = -(res[:, 2:] - res[:, :-2]) / (zs[2:] - zs[:-2])
+    zf = zs[np.argmax(dens, axis=1)]
+    if not vect:
+        zf = zf[0]
     if outc:
         return 0.7 + 0.77 * np.log10(zf)
     else:
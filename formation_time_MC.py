@@ -1,50 +1,592 @@
 import numpy as np
 import cosmo_parameters as cp
 from fluctuation_rms import  sigma
+from collections import namedtuple
+from functools import lru_cache
 
 def parkinson08(zi, Mi, Mres, zf, dz = 1e-3,frac=0.5, acc=10000, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=1000, om0=cp.om,
-          ol0=cp.oml, omb=cp.omb, camb=False, colos=True):
+          ol0=cp.oml, omb=cp.omb, camb=False, colos=True, tree=False, rng=None):
+    """
+    Monte Carlo merger tree of a halo of mass Mi at redshift zi, with binary splits at each redshift step.
+    :param zi: float : redshift of the root halo
+    :param Mi: float : mass of the root halo
+    :param Mres: float : mass resolution, halos below 5*Mres are not split
+    :param zf: float : highest redshift of the tree
+    :param dz: float : redshift step
+    :param frac: float : maximum mass fraction of the smaller progenitor
+    :param acc: int : number of mass bins of the progenitor distribution
+    :param tree: bool : if True returns a MergerTree with the links between halos
+    :param rng: numpy.random.Generator. Default : a new generator seeded by the system
+    See formation_time.proba for the other parameters
+    :return: (list, ndarray) : masses of the halos at each step, one array per redshift, and the redshifts. MergerTree
+    if tree
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    spline = sigma_spline(sig8, h, kmax, window, prec, om0, ol0, omb, camb, colos)[0]
+    table = progenitor_table(Mres, Mi, frac, 0, acc, sig8=sig8, h=h, kmax=kmax, window=window, prec=prec, om0=om0,
+                             ol0=ol0, omb=omb, camb=camb, colos=colos)  # EPS distribution of the progenitors
+    Smin, Sres = np.exp(spline(np.log([1e-5, Mres])))  # unresolved masses from 1e-5 to Mres
     zs = np.arange(zi, zf, dz)
-    mass_tree = [[Mi]]
+    ws = cp.delta_c(zs, om0, ol0)
+    mass_tree = [np.array([Mi], dtype=float)]
+    desc_tree = [np.array([-1])]  # index of the descendant of each halo in the previous step
     for i in range(len(zs)-1):
-        mass_tree_M = []
-        for M in mass_tree[i]:
-            if M > 5*Mres:
-                R = np.random.uniform(0,1)
-                S0 = sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos)**2 #variance of the field at mass M
-                w0 = cp.delta_c(zs[i], om0, ol0)  #critical density at observed redshift
-                dw = cp.delta_c(zs[i+1], om0, ol0) - w0
-                M1s = np.logspace(np.log10(Mres), np.log10(frac*M), acc)
-                S1s = sigma(M1s, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos)**2 #variance of the field at mass M
-                dS1 = (S1s[2:] - S1s[:-2])*0.5
-                dM1 = (M1s[2:]-M1s[:-2])*0.5
-                #dlsig = np.log(S1s[2:]) - np.log(S1s[:-2])*0.5
-                #dlM =  np.log(M1s[2:]) - np.log(M1s[:-2])*0.5
-                #dNdM1 = -M*S1s[1:-1]*(S1s[1:-1]-S0)**(-1.5)*dw*dlsig/(np.sqrt(2*np.pi)*dz*dlM*M1s**2)
-                #dM1 = M1s[2:]-M1s[:-2]
-                dNdM1 = -M*(S1s[1:-1]-S0)**(-1.5)*dw*dS1/(np.sqrt(2*np.pi)*dM1*M1s[1:-1])
-                P = np.sum(dNdM1*dM1)
-                Pcum = np.cumsum(dNdM1*dM1)
-                M2s = np.logspace(-5, np.log10(Mres), acc)
-                S2s = sigma(M2s, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos)**2
-                #F = special.erfc(dw/np.sqrt(2*(S2s[0]-S2s[-1])))
-                dS2 = (S2s[2:] - S2s[:-2])*0.5
-                dM2 = (M2s[2:] - M2s[:-2])*0.5
-                dNdM2 = -(S2s[1:-1]-S0)**(-1.5)*dw*dS2/(np.sqrt(2*np.pi)*dM2)
-                F = np.sum(dNdM2*dM2)
-                if R > P:
-                    mass_tree_M.append(M*(1-F))
-                else:
-                    mass = np.min(M1s[1:-1][Pcum>R])
-                    mass_tree_M.append(mass)
-                    mass_tree_M.append(-mass + M*(1-F))
-            else:
-                 mass_tree_M.append(M)
-        mass_tree.append(mass_tree_M)
-        #print(np.sum(np.array(mass_tree[i+1]))/Mi)
+        M = mass_tree[i].copy()
+        desc = np.arange(len(M))
+        big = np.nonzero(M > 5*Mres)[0]  # all the halos that can split are drawn at once
+        R = rng.random(len(big))
+        dw = ws[i+1] - ws[i]
+        lM = np.log(M[big])
+        S0 = np.exp(spline(lM))  # variance of the field at mass M
+        P = np.interp(lM, table.lM, table.rate)*dw
+        F = unresolved_fraction(S0, Sres, dw, Smin)
+        split = R < P
+        M1 = sample_progenitors(table, lM[split], R[split]/P[split])
+        Mb = M[big]*(1-F)
+        Mb[split] -= M1
+        M[big] = Mb
+        mass_tree.append(np.concatenate([M, M1]))
+        desc_tree.append(np.concatenate([desc, big[split]]))
+    if tree:
+        return link_tree(mass_tree, desc_tree, zs)
     return mass_tree, zs
 
-tree, reds = parkinson08(0.1, 1e13, 1e10, zf=5, dz=1e-4)
+
+########################################################################################################################
+
+####################################-------------------Tree storage------------------###################################
+
+########################################################################################################################
+
+MergerTree = namedtuple('MergerTree', ['mass', 'snap', 'desc', 'first_prog', 'next_sib', 'redshifts'])
+MergerTree.__doc__ = """Merger tree as a structure of arrays, one entry per halo at each output redshift, ordered by
+redshift. mass : mass of the halo. snap : index of its redshift in redshifts. desc : index of its descendant, -1 for the
+root. first_prog : index of its most massive progenitor, -1 if none. next_sib : index of the next progenitor of the
+same descendant, by decreasing mass, -1 if none. The indices are relative to the first halo of the tree"""
+tree_fields = ('mass', 'snap', 'desc', 'first_prog', 'next_sib')
+
+
+def link_tree(masses, descs, zs):
+    """
+    MergerTree from the masses of the halos at each redshift and the index of their descendant at the previous one.
+    The progenitors of a halo are stored contiguously, the most massive first.
+    :param masses: list of arrays : masses at each redshift
+    :param descs: list of arrays : index of the descendant of each halo among the halos of the previous redshift
+    :param zs: array : redshifts
+    :return: MergerTree
+    """
+    mass, desc = [np.asarray(masses[0], dtype=float)], [np.full(len(masses[0]), -1)]
+    start = 0  # index of the first halo of the previous redshift
+    rank = np.arange(len(masses[0]))  # position of the halos of the previous redshift once sorted
+    for m, d in zip(masses[1:], descs[1:]):
+        m, d = np.asarray(m, dtype=float), rank[np.asarray(d, dtype=int)]
+        order = np.lexsort((-m, d))
+        mass.append(m[order])
+        desc.append(d[order] + start)
+        start += len(rank)
+        rank = np.empty(len(order), dtype=int)
+        rank[order] = np.arange(len(order))
+    mass, desc = np.concatenate(mass), np.concatenate(desc)
+    snap = np.repeat(np.arange(len(masses)), [len(el) for el in masses])
+    first_prog = np.full(len(mass), -1)
+    has = np.nonzero(desc >= 0)[0]
+    uniq, first = np.unique(desc[has], return_index=True)
+    first_prog[uniq] = has[first]
+    next_sib = np.full(len(mass), -1)
+    same = np.nonzero((desc[1:] == desc[:-1]) & (desc[1:] >= 0))[0]
+    next_sib[same] = same + 1
+    return MergerTree(mass, snap, desc, first_prog, next_sib, np.asarray(zs))
+
+
+def save_trees(path, trees, mass_dtype=np.float64):
+    """
+    Writes merger trees with the same redshifts in a directory of .npy files, one per field of MergerTree plus the
+    index of the first halo of each tree (offsets), so that they can be memory mapped by load_trees
+    :param path: str : directory, created if needed
+    :param trees: list of MergerTree
+    :param mass_dtype: numpy type of the stored masses, np.float32 halves their size
+    :return: None
+    """
+    import os
+    zs = trees[0].redshifts
+    if any(len(el.redshifts) != len(zs) or np.any(el.redshifts != zs) for el in trees):
+        raise ValueError("the trees do not have the same redshifts")
+    os.makedirs(path, exist_ok=True)
+    for name in tree_fields:
+        arr = np.concatenate([getattr(el, name) for el in trees])
+        np.save(os.path.join(path, name + '.npy'), arr.astype(mass_dtype if name == 'mass' else np.int32))
+    np.save(os.path.join(path, 'offsets.npy'), np.cumsum([0] + [len(el.mass) for el in trees]))
+    np.save(os.path.join(path, 'redshifts.npy'), zs)
+
+
+def load_trees(path, mmap=True):
+    """
+    Reads the trees written by save_trees
+    :param path: str : directory
+    :param mmap: bool : memory map the arrays instead of reading them
+    :return: (MergerTree, ndarray) : fields of all the trees concatenated, index of the first halo of each tree and
+    total number of halos (n_trees + 1, ). See get_tree
+    """
+    import os
+    mode = 'r' if mmap else None
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mode) for name in tree_fields]
+    trees = MergerTree(*arrays, np.load(os.path.join(path, 'redshifts.npy')))
+    return trees, np.load(os.path.join(path, 'offsets.npy'))
+
+
+def get_tree(trees, offsets, i):
+    """
+    Tree i of the concatenated trees returned by load_trees, as views of the arrays
+    :return: MergerTree
+    """
+    sl = slice(offsets[i], offsets[i + 1])
+    return MergerTree(*[getattr(trees, name)[sl] for name in tree_fields], trees.redshifts)
+
+
+########################################################################################################################
+
+#################################-------------------Tabulated PCH08 engine------------------############################
+
+########################################################################################################################
+
+ProgenitorTable = namedtuple('ProgenitorTable', ['lM', 'rate', 'inverse', 'lMres', 'lfrac'])
+ProgenitorTable.__doc__ = """Progenitor mass distribution of Parkinson, Cole & Helly (2008) tabulated on a grid of parent masses.
+lM : ln of the parent masses, evenly spaced. rate : number of resolved progenitors per unit delta_c, without the
+G0 (w/sigma)^gamma2 factor. inverse : (len(lM), n) fraction u of the interval [ln Mres, ln(frac M)] at which the
+cumulative distribution reaches r = linspace(0, 1, n). lMres, lfrac : ln of the resolution and of frac"""
+
+
+@lru_cache(maxsize=8)
+def sigma_spline(sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=1000, om0=cp.om, ol0=cp.oml, omb=cp.omb,
+                 camb=False, colos=True, lMmin=-5, lMmax=17, n=500):
+    """
+    Cubic spline of ln S = ln sigma^2 as a function of ln M for one cosmology, and its derivative dln S/dln M. Built
+    once from a single call to sigma and kept for the following trees.
+    :param lMmin: float : log10 of the lowest tabulated mass
+    :param lMmax: float : log10 of the highest tabulated mass
+    :param n: int : number of tabulated masses
+    See formation_time.proba for the other parameters
+    :return: (CubicSpline, CubicSpline) : ln S(ln M) and its derivative
+    """
+    from scipy.interpolate import CubicSpline
+    M = np.logspace(lMmin, lMmax, n)
+    spline = CubicSpline(np.log(M), 2 * np.log(sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb, colos)))
+    return spline, spline.derivative()
+
+
+@lru_cache(maxsize=8)
+def progenitor_table(Mres, Mmax, frac=0.5, gamma1=0.38, acc=1000, nparent=256, sig8=cp.sigma8, h=cp.h, kmax=30,
+                     window='TopHat', prec=1000, om0=cp.om, ol0=cp.oml, omb=cp.omb, camb=False, colos=True):
+    """
+    Tabulates for parent masses from Mres/frac to Mmax the rate of resolved progenitors of mass Mres < M1 < frac M,
+    dN/dw dlnM1 = (M/M1) |dS1/dlnM1| (S1 - S)^-1.5 (sigma1/sigma)^gamma1 / sqrt(2 pi), and the inverse of its cumulative
+    distribution, so that progenitor masses are drawn by interpolation (see sample_progenitors).
+    :param Mres: float : mass resolution
+    :param Mmax: float : highest parent mass
+    :param frac: float : maximum mass fraction of the smaller progenitor
+    :param gamma1: float : exponent of sigma1/sigma in the G factor of PCH08, 0 for the EPS distribution
+    :param acc: int : number of progenitor masses per parent and of points of the inverse distribution
+    :param nparent: int : number of parent masses
+    See formation_time.proba for the other parameters
+    :return: ProgenitorTable
+    """
+    spline, dspline = sigma_spline(sig8, h, kmax, window, prec, om0, ol0, omb, camb, colos)
+    lMres, lfrac = np.log(Mres), np.log(frac)
+    lM = np.linspace(lMres - lfrac, np.log(max(Mmax, Mres / frac)), nparent)
+    u = np.linspace(0, 1, acc)
+    lM1 = lMres + u * (lM[:, None] + lfrac - lMres)  # (nparent, acc)
+    S = np.exp(spline(lM))[:, None]
+    S1 = np.exp(spline(lM1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dens = np.exp(lM[:, None] - lM1) * S1 * np.abs(dspline(lM1)) * (S1 - S) ** -1.5 * (S1 / S) ** (gamma1 / 2) / \
+            np.sqrt(2 * np.pi)
+        dl = (lM + lfrac - lMres)[:, None] * (u[1] - u[0])
+        cumul = np.concatenate([np.zeros((nparent, 1)), np.cumsum(0.5 * (dens[:, 1:] + dens[:, :-1]) * dl, axis=1)],
+                               axis=1)
+    rate = cumul[:, -1]
+    rate[0] = 0  # the parent of mass Mres/frac has no resolved progenitor
+    inverse = np.array([np.interp(u, el / el[-1], u) if el[-1] > 0 else u for el in cumul])
+    return ProgenitorTable(lM, rate, inverse, lMres, lfrac)
+
+
+def sample_progenitors(table, lM, r):
+    """
+    Masses of progenitors drawn by bilinear interpolation of the inverse cumulative distribution of the table
+    :param table: ProgenitorTable
+    :param lM: array : ln of the parent masses
+    :param r: array : uniform random numbers in [0, 1], one per parent
+    :return: array : progenitor masses
+    """
+    x = (lM - table.lM[0]) / (table.lM[1] - table.lM[0])
+    i = np.clip(x.astype(int), 0, len(table.lM) - 2)
+    t = np.clip(x - i, 0, 1)
+    y = r * (table.inverse.shape[1] - 1)
+    j = np.minimum(y.astype(int), table.inverse.shape[1] - 2)
+    v = y - j
+    inv = table.inverse
+    u = (1 - t) * ((1 - v) * inv[i, j] + v * inv[i, j + 1]) + t * ((1 - v) * inv[i + 1, j] + v * inv[i + 1, j + 1])
+    return np.exp(table.lMres + u * (lM + table.lfrac - table.lMres))
+
+
+def unresolved_fraction(S0, Sres, dw, Smin=np.inf):
+    """
+    Fraction of mass accreted in progenitors below the resolution during a step dw, the integral of the EPS
+    progenitor mass distribution between the variances Sres and Smin :
+    sqrt(2/pi) dw ((Sres - S0)^-1/2 - (Smin - S0)^-1/2)
+    :param S0: float or array : variance at the mass of the halos
+    :param Sres: float : variance at the mass resolution
+    :param dw: float or array : step in delta_c
+    :param Smin: float : variance at the lowest accreted mass. Default : no lower mass
+    :return: float or array
+    """
+    return np.sqrt(2 / np.pi) * dw * ((Sres - S0) ** -0.5 - (Smin - S0) ** -0.5)
+
+
+@lru_cache(maxsize=8)
+def _j_table(gamma1, n=2000):
+    """ln u and J(u)/u, J(u) the integral from 0 to u of (1 + 1/x^2)^(gamma1/2), for the unresolved fraction of PCH08"""
+    lx = np.linspace(np.log(1e-8), np.log(1e8), n)
+    x = np.exp(lx)
+    f = x * (1 + x ** -2) ** (gamma1 / 2)  # integrand in ln x
+    J = x[0] ** (1 - gamma1) / (1 - gamma1) + np.concatenate([[0], np.cumsum(0.5 * (f[1:] + f[:-1]) * np.diff(lx))])
+    return lx, J / x
+
+
+def merger_tree(zi, Mi, Mres, zf, dz=0.05, frac=0.5, acc=1000, eps1=0.1, eps2=0.1, G0=0.57, gamma1=0.38,
+                gamma2=-0.01, rng=None, sig8=cp.sigma8, h=cp.h, kmax=30, window='TopHat', prec=1000, om0=cp.om,
+                ol0=cp.oml, omb=cp.omb, camb=False, colos=True):
+    """
+    Monte Carlo merger tree of a halo of mass Mi at redshift zi with the algorithm of Parkinson, Cole & Helly (2008).
+    Between two output redshifts every halo is evolved with its own steps in delta_c, dw < eps1 sqrt(2 (S(frac M) -
+    S(M))) and such that the probability of a split stays below eps2. sigma and the progenitor distribution are
+    interpolated in tables built once per cosmology (see sigma_spline and progenitor_table), and each step is done for
+    all the halos at once. Halos below Mres/frac cannot have resolved progenitors and are kept unchanged.
+    In the EPS limit (G0=1, gamma1=gamma2=0) the binary splits underestimate the high redshift tail of the EPS
+    formation redshifts, as any binary split scheme does (see benchmarks.tree_benchmark).
+    :param zi: float : redshift of the root halo
+    :param Mi: float : mass of the root halo
+    :param Mres: float : mass resolution
+    :param zf: float : highest redshift of the tree
+    :param dz: float : interval between the output redshifts
+    :param frac: float : maximum mass fraction of the smaller progenitor
+    :param acc: int : resolution of the progenitor table
+    :param eps1: float : maximum step in units of sqrt(2 (S(frac M) - S(M)))
+    :param eps2: float : maximum probability of a split in a step
+    :param G0: float : normalisation of the G factor of PCH08 modifying the EPS progenitor distribution
+    :param gamma1: float : exponent of sigma1/sigma of the G factor
+    :param gamma2: float : exponent of delta_c/sigma of the G factor. G0=1, gamma1=gamma2=0 gives EPS
+    :param rng: numpy.random.Generator. Default : a new generator seeded by the system
+    See formation_time.proba for the other parameters
+    :return: MergerTree
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    spline = sigma_spline(sig8, h, kmax, window, prec, om0, ol0, omb, camb, colos)[0]
+    table = progenitor_table(Mres, Mi, frac, gamma1, acc, sig8=sig8, h=h, kmax=kmax, window=window, prec=prec, om0=om0,
+                             ol0=ol0, omb=omb, camb=camb, colos=colos)
+    lj, jratio = _j_table(gamma1)
+    Sres = np.exp(spline(np.log(Mres)))
+    Msplit = Mres / frac  # lowest mass with resolved progenitors
+    zs = np.arange(zi, zf, dz)
+    ws = cp.delta_c(zs, om0, ol0)
+    mass_tree = [np.array([Mi], dtype=float)]
+    desc_tree = [np.array([-1])]
+    for i in range(len(zs) - 1):
+        M = mass_tree[i].copy()
+        desc = np.arange(len(M))  # halo of the previous redshift from which each halo comes
+        w = np.where(M < Msplit, ws[i + 1], ws[i])
+        act = np.nonzero(w < ws[i + 1])[0]
+        while len(act):
+            Ma, wa = M[act], w[act]
+            lM = np.log(Ma)
+            S0 = np.exp(spline(lM))
+            G = G0 * (wa / np.sqrt(S0)) ** gamma2
+            rate = np.interp(lM, table.lM, table.rate) * G
+            dw = np.minimum(eps1 * np.sqrt(2 * (np.exp(spline(lM + table.lfrac)) - S0)), eps2 / rate)
+            last = dw >= ws[i + 1] - wa
+            dw = np.where(last, ws[i + 1] - wa, dw)
+            u = np.sqrt(S0 / (Sres - S0))  # sigma / sqrt(Sres - S0)
+            F = unresolved_fraction(S0, Sres, dw) * G * np.interp(np.log(u), lj, jratio)
+            P = rate * dw
+            R = rng.random(len(act))
+            split = R < P
+            wa = np.where(last, ws[i + 1], wa + dw)
+            Ma = Ma * (1 - F)
+            if np.any(split):
+                M1 = sample_progenitors(table, lM[split], R[split] / P[split])
+                Ma[split] -= M1
+                M = np.concatenate([M, M1])
+                w = np.concatenate([w, wa[split]])
+                desc = np.concatenate([desc, desc[act[split]]])
+            M[act] = Ma
+            w[act] = wa
+            w[M < Msplit] = ws[i + 1]
+            act = np.nonzero(w < ws[i + 1])[0]
+        mass_tree.append(M)
+        desc_tree.append(desc)
+    return link_tree(mass_tree, desc_tree, zs)
+
+
+########################################################################################################################
+
+######################################-------------------Ensembles------------------####################################
+
+########################################################################################################################
+
+
+def _ensemble_worker(task):
+    """One tree of run_ensemble from its own random stream. Defined at module level to be sent to the workers"""
+    seed, engine, kwargs = task
+    rng = np.random.default_rng(seed)
+    if engine == 'parkinson08':
+        return parkinson08(tree=True, rng=rng, **kwargs)
+    return merger_tree(rng=rng, **kwargs)
+
+
+def _ensemble_init(engine, kwargs):
+    """Builds the sigma and progenitor tables in a worker, a no-op when they were inherited from the parent"""
+    args = dict(kwargs, zf=kwargs['zi'])  # a tree without steps
+    _ensemble_worker((0, engine, args))
+
+
+def merge_trees(path, parts, mass_dtype=np.float64):
+    """
+    Concatenates the tree directories written by save_trees into a single one, copying them one at a time through
+    memory maps
+    :param path: str : output directory
+    :param parts: list of str : input directories, in order
+    :param mass_dtype: numpy type of the stored masses
+    :return: None
+    """
+    import os
+    stores = [load_trees(el) for el in parts]
+    os.makedirs(path, exist_ok=True)
+    for name in tree_fields:
+        total = sum(len(getattr(el[0], name)) for el in stores)
+        dtype = mass_dtype if name == 'mass' else np.int32
+        out = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype, shape=(total,))
+        start = 0
+        for trees, _ in stores:
+            arr = getattr(trees, name)
+            out[start:start + len(arr)] = arr
+            start += len(arr)
+        out.flush()
+        del out
+    offsets = [np.zeros(1, dtype=int)]
+    for trees, off in stores:
+        offsets.append(off[1:] + offsets[-1][-1])
+    np.save(os.path.join(path, 'offsets.npy'), np.concatenate(offsets))
+    np.save(os.path.join(path, 'redshifts.npy'), stores[0][0].redshifts)
+
+
+def run_ensemble(path, ntrees, seed=None, engine='pch08', processes=None, batch=1000, mass_dtype=np.float64,
+                 **kwargs):
+    """
+    Generates an ensemble of merger trees in a process pool and stores them in path (see load_trees). Each tree has its
+    own random stream spawned from seed by numpy.random.SeedSequence, so the ensemble only depends on seed, whatever
+    the number of processes. Trees are written every batch trees in a part directory, and the parts are merged at the
+    end. The arguments of the run are written in manifest.json : an interrupted run is resumed from the parts already
+    written when it is restarted with the same seed and arguments, a restart with other ones or with seed None raises
+    a ValueError.
+    :param path: str : output directory
+    :param ntrees: int : number of trees
+    :param seed: int or None : entropy of the ensemble. None draws a new one
+    :param engine: str : 'pch08' for merger_tree, 'parkinson08' for parkinson08
+    :param processes: int : number of worker processes. Default : number of cpus. 1 runs serially
+    :param batch: int : number of trees per part
+    :param mass_dtype: numpy type of the stored masses
+    :param kwargs: arguments of the engine : zi, Mi, Mres, zf, dz, cosmological parameters...
+    :return: int : entropy of the ensemble, to reproduce it when seed is None
+    """
+    import os
+    import json
+    import shutil
+    import tempfile
+    sequence = np.random.SeedSequence(seed)
+    manifest = json.loads(json.dumps({'entropy': sequence.entropy, 'ntrees': ntrees, 'batch': batch, 'engine': engine,
+                                      'mass_dtype': np.dtype(mass_dtype).str, 'kwargs': kwargs}, sort_keys=True,
+                                     default=repr))
+    tasks = [(el, engine, kwargs) for el in sequence.spawn(ntrees)]
+    parts = [os.path.join(path, 'part_%05d' % n) for n in range(0, (ntrees + batch - 1) // batch)]
+    todo = [n for n, el in enumerate(parts) if not os.path.isdir(el)]
+    if len(todo) < len(parts):  # resuming an interrupted run
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                previous = json.load(f)
+        except FileNotFoundError:
+            previous = None
+        if seed is None:
+            raise ValueError("%s holds the parts of an unfinished ensemble, resuming it needs an explicit seed%s"
+                             % (path, '' if previous is None else ' (%d)' % previous['entropy']))
+        if previous != manifest:
+            raise ValueError("the parts in %s were generated with other arguments : %s" % (path, previous))
+    else:
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+    executor = None
+    _ensemble_init(engine, kwargs)  # the tables are inherited by forked workers
+    if processes != 1 and todo:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=processes, initializer=_ensemble_init, initargs=(engine, kwargs))
+    try:
+        for n in todo:
+            chunk = tasks[n * batch:(n + 1) * batch]
+            if executor is None:
+                trees = [_ensemble_worker(el) for el in chunk]
+            else:
+                trees = list(executor.map(_ensemble_worker, chunk, chunksize=max(1, len(chunk) // 64)))
+            tmp = tempfile.mkdtemp(dir=path, prefix='.tmp')
+            save_trees(tmp, trees, mass_dtype)
+            os.rename(tmp, parts[n])  # a part is only visible once complete
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    merge_trees(path, parts, mass_dtype)
+    for el in parts:
+        shutil.rmtree(el)
+    return sequence.entropy
+
+
+########################################################################################################################
+
+#################################-------------------Formation redshifts------------------###############################
+
+########################################################################################################################
+
+
+def iter_trees(path, mmap=True):
+    """
+    Trees of a directory written by save_trees or run_ensemble, one at a time
+    :param path: str : directory
+    :param mmap: bool : memory map the arrays instead of reading them
+    :return: generator of MergerTree
+    """
+    trees, offsets = load_trees(path, mmap)
+    for i in range(len(offsets) - 1):
+        yield get_tree(trees, offsets, i)
+
+
+def main_branch(tree):
+    """
+    Main branch of a tree, following the most massive progenitor from the root
+    :param tree: MergerTree
+    :return: array : indices of the halos of the main branch, one per redshift until it ends
+    """
+    branch = [0]
+    while tree.first_prog[branch[-1]] >= 0:
+        branch.append(tree.first_prog[branch[-1]])
+    return np.array(branch)
+
+
+def formation_redshift(tree, frac=0.5):
+    """
+    Redshift at which the main branch of a tree falls below frac times the mass of the root, interpolated linearly
+    between the output redshifts
+    :param tree: MergerTree
+    :param frac: float between 0 and 1. Fraction of mass to define formation redshift
+    :return: float : z_f, inf if the main branch stays above frac at all the redshifts of the tree
+    """
+    branch = main_branch(tree)
+    m = tree.mass[branch] / tree.mass[0]
+    z = tree.redshifts[tree.snap[branch]]
+    below = np.nonzero(m < frac)[0]
+    if len(below) == 0:
+        return np.inf
+    k = below[0]
+    return z[k - 1] + (z[k] - z[k - 1]) * (m[k - 1] - frac) / (m[k - 1] - m[k])
+
+
+def _formation_worker(task):
+    """Formation redshift of one tree of formation_distribution, the tree itself is not sent back"""
+    frac, task = task
+    return formation_redshift(_ensemble_worker(task), frac)
+
+
+def formation_distribution(ntrees=0, zgrid=np.linspace(0, 7, 20), frac=0.5, quantiles=(0.16, 0.5, 0.84), nbins=1000,
+                           trees=None, seed=None, engine='pch08', processes=None, **kwargs):
+    """
+    Empirical distribution of the formation redshift of Monte Carlo trees, to compare with formation_time.proba (see
+    merger_tree for the bias of the pch08 engine). The formation redshifts are accumulated one tree at a time, in
+    counts on zgrid and in a histogram of nbins bins between zgrid[0] and zgrid[-1] for the quantiles, so that no
+    tree is kept. The trees are either generated in a process pool as in run_ensemble, or read from an iterable such
+    as iter_trees(path).
+    :param ntrees: int : number of trees to generate
+    :param zgrid: array : redshifts at which P(z_f > z) is given, as zf in formation_time.proba
+    :param frac: float between 0 and 1. Fraction of mass to define formation redshift
+    :param quantiles: list of floats : quantiles of z_f, nan when outside of [zgrid[0], zgrid[-1]]
+    :param nbins: int : number of bins of the histogram of z_f
+    :param trees: iterable of MergerTree or None : trees to use instead of generating them
+    :param seed: int or None : entropy of the generated trees
+    :param engine: str : 'pch08' for merger_tree, 'parkinson08' for parkinson08
+    :param processes: int : number of worker processes. Default : number of cpus. 1 runs serially
+    :param kwargs: arguments of the engine : zi, Mi, Mres, zf, dz, cosmological parameters...
+    :return: (ndarray, ndarray, int) : P(z_f > z) on zgrid, quantiles of z_f, number of trees
+    """
+    edges = np.linspace(zgrid[0], zgrid[-1], nbins + 1)
+    counts = np.zeros(len(zgrid))
+    hist = np.zeros(nbins + 2)  # below zgrid[0], bins, above zgrid[-1]
+    executor = None
+    if trees is not None:
+        zfs = (formation_redshift(el, frac) for el in trees)
+    else:
+        tasks = [(frac, (el, engine, kwargs)) for el in np.random.SeedSequence(seed).spawn(ntrees)]
+        _ensemble_init(engine, kwargs)
+        if processes == 1:
+            zfs = map(_formation_worker, tasks)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=processes, initializer=_ensemble_init,
+                                           initargs=(engine, kwargs))
+            zfs = executor.map(_formation_worker, tasks, chunksize=max(1, ntrees // 256))
+    n = 0
+    try:
+        for el in zfs:
+            counts += el > zgrid
+            hist[np.searchsorted(edges, el, side='right')] += 1
+            n += 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    cumul = np.cumsum(hist) / n  # fraction of z_f below each edge, then above the last one
+    res = []
+    for q in quantiles:
+        if q < cumul[0] or q > cumul[-2]:
+            res.append(np.nan)
+        else:
+            res.append(np.interp(q, cumul[:-1], edges))
+    return counts / n, np.array(res), n
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generates an ensemble of merger trees with run_ensemble')
+    parser.add_argument('output', help='directory of the trees')
+    parser.add_argument('--ntrees', type=int, default=1)
+    parser.add_argument('--zi', type=float, default=0.1)
+    parser.add_argument('--Mi', type=float, default=1e13)
+    parser.add_argument('--Mres', type=float, default=1e10)
+    parser.add_argument('--zf', type=float, default=5)
+    parser.add_argument('--dz', type=float, default=1e-4)
+    parser.add_argument('--frac', type=float, default=0.5)
+    parser.add_argument('--acc', type=int, default=10000)
+    parser.add_argument('--sig8', type=float, default=cp.sigma8)
+    parser.add_argument('--h', type=float, default=cp.h)
+    parser.add_argument('--om0', type=float, default=cp.om)
+    parser.add_argument('--ol0', type=float, default=cp.oml)
+    parser.add_argument('--omb', type=float, default=cp.omb)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--engine', choices=['pch08', 'parkinson08'], default='parkinson08')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--batch', type=int, default=1000)
+    opts = parser.parse_args()
+
+    entropy = run_ensemble(opts.output, opts.ntrees, opts.seed, opts.engine, opts.processes, opts.batch, zi=opts.zi,
+                           Mi=opts.Mi, Mres=opts.Mres, zf=opts.zf, dz=opts.dz, frac=opts.frac, acc=opts.acc,
+                           sig8=opts.sig8, h=opts.h, om0=opts.om0, ol0=opts.ol0, omb=opts.omb)
+    print('%d trees written in %s, seed %d' % (opts.ntrees, opts.output, entropy))
 
 '''zi = 0.1
 zf = 2
@@ -1,14 +1,7 @@
 import numpy as np
-from colossus.lss import mass_function
-from colossus.lss import peaks
-from colossus.cosmology import cosmology
 import cosmo_parameters as cp
 import fluctuation_rms as fm
 
-base_cosmo = {'flat': True, 'H0': 100 * cp.h, 'Om0': cp.om, 'Ode0': cp.oml, 'Ob0': cp.omb, 'sigma8': cp.sigma8,
-            'ns': cp.ns}
-cosmology.setCosmology('my_cosmo', base_cosmo)
-
 
 ########################################################################################################################
 
@@ -59,8 +52,8 @@ def nu(M, z, om0=cp.om, ol0=cp.oml, omb=cp.omb, sig8=cp.sigma8, h=cp.h, kmax=30,
     :return: peak height
     """
     if Colos:
-        my_cosmo = {'flat': True, 'H0': 100 * h, 'Om0': om0, 'Ode0': ol0, 'Ob0': omb, 'sigma8': sig8, 'ns': cp.ns}
-        cosmology.setCosmology('my_cosmo', my_cosmo)
+        from colossus.lss import peaks
+        fm.colossus_cosmology(sig8, h, omb, om0, ol0, cp.ns)
         return peaks.peakHeight(M, z)
     else:
         del_c = cp.delta_c(z, om0, ol0)  # critical overdensity
@@ -83,7 +76,7 @@ def nu(M, z, om0=cp.om, ol0=cp.oml, omb=cp.omb, sig8=cp.sigma8, h=cp.h, kmax=30,
 
 
 def hmf(M, z=0, window='TopHat', sig8=cp.sigma8, om0=cp.om, ol0=cp.oml, omb=cp.omb, h=cp.h, kmax=30, prec=1000,
-        out='hmf', model='sheth', A=0.322, a=0.707, p=0.3, camb=False):
+        out='hmf', model='sheth', A=0.322, a=0.707, p=0.3, camb=False, tab=True, tab_prec=None):
     """
 
     :param M: float or array: mass or array of mass. If array, minimum size = 3.
@@ -99,6 +92,8 @@ def hmf(M, z=0, window='TopHat', sig8=cp.sigma8, om0=cp.om, ol0=cp.oml, omb=cp.o
     :param out: str : type of output. Either "hmf" for number density per unit mass. or "dn/dlnM" or "dimensionless"
     :param camb: boolean : if using camb spectrum or analytical version of Eisenstein and Hu
     :param model: string : Halo Mass Function model. Either Sheth & Tormen 2001 or Press & Schechter 1973
+    :param tab: boolean : interpolate sigma in the tabulated sigma(R) of the cosmology (see fluctuation_rms.sigma_table)
+    :param tab_prec: int : number of R bins per decade of the sigma(R) table. Default : fluctuation_rms.sigma_tab_prec
     :return: float, array of floats.
     """
     if type(z) == np.ndarray:  # case multiple redshifts
@@ -108,7 +103,7 @@ def hmf(M, z=0, window='TopHat', sig8=cp.sigma8, om0=cp.om, ol0=cp.oml, omb=cp.o
         if type(M) == np.ndarray or type(M) == list:  # case M is an array
             n = len(M) - 2  # n - 2 because we will do a derivative
             sig = fm.sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb,
-                        camb)  # array of fluctiation rmsshape : (n,)
+                        camb, tab=tab, tab_prec=tab_prec)  # array of fluctiation rmsshape : (n,)
             dlsig = np.log(sig[2:] / sig[:-2])  # differential of sigma. shape : (n-2, )
             dlM = np.log(M[2:] / M[:-2])  # differential of mass shape : (n-2, )
             new_sig = (sig[2:] + sig[:-2]) * 0.5  # averaging to get the same size as dlsig. shape : (n-2, )
@@ -136,7 +131,7 @@ def hmf(M, z=0, window='TopHat', sig8=cp.sigma8, om0=cp.om, ol0=cp.oml, omb=cp.o
         else:  # case of unique M
             nM = np.array([0.99999 * M, 1.00001 * M])  # to get a derivative at M
             sig = fm.sigma(nM, sig8, h, kmax, window, 'M', prec, om0, ol0, omb,
-                        camb=camb)  # get sigma for values close to M
+                        camb=camb, tab=tab, tab_prec=tab_prec)  # get sigma for values close to M
             dlsig = np.log(sig[1:] / sig[:-1])  # differential of log sigma at M
             dlM = np.log(nM[1:] / nM[:-1])  # differential of log M at M
             new_sig = (sig[1:] + sig[:-1]) * 0.5  # taking the average as the value for sigma(M) to be symetric wr M
@@ -159,7 +154,8 @@ def hmf(M, z=0, window='TopHat', sig8=cp.sigma8, om0=cp.om, ol0=cp.oml, omb=cp.o
     else:  # case of unique z
         del_c = cp.delta_c(z, om0, ol0)
         if type(M) == np.ndarray or type(M) == list:
-            sig = fm.sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb=camb)  # fluctuation rms
+            sig = fm.sigma(M, sig8, h, kmax, window, 'M', prec, om0, ol0, omb, camb=camb, tab=tab,
+                           tab_prec=tab_prec)  # fluctuation rms
             dlsig = np.log(sig[2:] / sig[:-2])  # differential of log sigma
             dlM = np.log(M[2:] / M[:-2])  # differential of log M
             new_sig = (sig[2:] + sig[
@@ -182,7 +178,7 @@ def hmf(M, z=0, window='TopHat', sig8=cp.sigma8, om0=cp.om, ol0=cp.oml, omb=cp.o
         else:
             nM = np.array([0.99999 * M, 1.00001 * M])  # to get a derivative at M
             sig = fm.sigma(nM, sig8, h, kmax, window, 'M', prec, om0, ol0, omb,
-                        camb=camb)  # get sigma for values close to M
+                        camb=camb, tab=tab, tab_prec=tab_prec)  # get sigma for values close to M
             dlsig = np.log(sig[1:] / sig[:-1])  # differential of log sigma at M
             dlM = np.log(nM[1:] / nM[:-1])  # differential of log M at M
             new_sig = (sig[1:] + sig[:-1]) * 0.5  # taking the average as the value for sigma(M) to be symetric wr M
@@ -231,8 +227,8 @@ def Mstar(lMmin=6, lMmax=15, npoints=10000, z=0, h=cp.h, om0=cp.om, ol0=cp.oml,
     :return: float : caracteristic non linear mass
     """
     if Colossus:
-        my_cosmo = {'flat': True, 'H0': 100 * h, 'Om0': om0, 'Ode0': ol0, 'Ob0': omb, 'sigma8': sigma8, 'ns': cp.ns}
-        cosmology.setCosmology('my_cosmo', my_cosmo)
+        from colossus.lss import peaks
+        fm.colossus_cosmology(sigma8, h, omb, om0, ol0, cp.ns)
         return peaks.nonLinearMass(z)
     else:
         mass = np.logspace(lMmin, lMmax, npoints)
@@ -331,8 +327,8 @@ def nofm(M, lMmax=18, z=0, window='TopHat', sigma8=cp.sigma8, om0=cp.om, ol0=cp.
     """
     from scipy.integrate import quad
     if Colos:
-        my_cosmo = {'flat': True, 'H0': 100 * h, 'Om0': om0, 'Ode0': ol0, 'Ob0': omb, 'sigma8': sigma8, 'ns': cp.ns}
-        cosmo = cosmology.setCosmology('my_cosmo', my_cosmo)
+        from colossus.lss import mass_function
+        fm.colossus_cosmology(sigma8, h, omb, om0, ol0, cp.ns)
 
         def dn(x):
             return np.exp(x) * mass_function.massFunction(np.exp(x), z, model='press74', q_out='dndlnM')
@@ -365,8 +361,8 @@ def nofm_man(M, lMmax=20, z=0, window='TopHat', sigma8=cp.sigma8, om0=cp.om, ol0
     dlM = np.log(10) * (lMmax - np.log10(M)) / acc  # differential in log mass
 
     if Colos:
-        my_cosmo = {'flat': True, 'H0': 100 * h, 'Om0': om0, 'Ode0': ol0, 'Ob0': omb, 'sigma8': sigma8, 'ns': cp.ns}
-        cosmology.setCosmology('my_cosmo', my_cosmo)
+        from colossus.lss import mass_function
+        fm.colossus_cosmology(sigma8, h, omb, om0, ol0, cp.ns)
         y = mass_function.massFunction(Ms[1:-1], z, model='press74', q_out='dndlnM')
         return np.sum(y * dlM)
     elif type(z) == np.ndarray:
@@ -380,6 +376,10 @@ def nofm_man(M, lMmax=20, z=0, window='TopHat', sigma8=cp.sigma8, om0=cp.om, ol0
 
 
 if __name__ == "__main__":
+    from colossus.lss import mass_function
+    from colossus.lss import peaks
+    from colossus.cosmology import cosmology
+
     #######################-------------------------------Halo Mass Function plot----------------###########################
 
     '''import matplotlib.pyplot as plt
@@ -1,5 +1,7 @@
 import numpy as np
 import cosmo_parameters as cp
+from collections import namedtuple
+from functools import lru_cache
 
 ########################################################################################################################
 
@@ -7,15 +9,19 @@ import cosmo_parameters as cp
 
 ########################################################################################################################
 
-def transfer(k, omega=cp.om, omega_b=cp.omb, h=cp.h, Tcmb=cp.Tcmb):
+TransferCoefficients = namedtuple('TransferCoefficients', ['omega', 'omega_b', 'h', 'theta_cmb', 'z_eq', 'k_eq', 'z_d',
+                                                           'Rd', 's', 'ks', 'al_c', 'bet_c', 'al_b', 'bet_b', 'bnode'])
+
+
+def transfer_coefficients(omega=cp.om, omega_b=cp.omb, h=cp.h, Tcmb=cp.Tcmb):
     """
-    Transfer function from Eisenstein and Hu 1998
-    :param k : wave number
+    Cosmology dependent constants of the Eisenstein and Hu 1998 transfer function. The parameters can be arrays, e.g. of
+    shape (n_cosmo, 1) to be broadcast against wavenumbers of shape (1, n_k) in transfer
     :param omega: fraction density of matter
     :param omega_b: fraction density of baryons
     :param h: normalized hubble value
     :param Tcmb: CMB temperature
-    :return: transfer function
+    :return: TransferCoefficients
     """
     ####----Cosmo params--------######
     omc = omega - omega_b      #### Cold Dark Matter density
@@ -42,9 +48,6 @@ def transfer(k, omega=cp.om, omega_b=cp.omb, h=cp.h, Tcmb=cp.Tcmb):
     ##----##-------equation 7
     ks = 1.6*(omega_b*h**2)**0.52*(omega*h**2)**0.73*(1 + (10.4*omega*h**2)**(-0.95)) #silk damping scale
 
-    ##-------equation  10
-    nq = theta_cmb**2*k/(omega*h**2)   #normalized wavenumber
-
     ##-------equation 11
     a1 = (46.9 * omega * h ** 2) ** 0.670 * (1 + (32.1 * omega * h ** 2) ** (-0.532))
     a2 = (12 * omega * h ** 2) ** 0.424 * (1 + (45 * omega * h ** 2) ** (-0.582))
@@ -65,12 +68,158 @@ def transfer(k, omega=cp.om, omega_b=cp.omb, h=cp.h, Tcmb=cp.Tcmb):
 
     ##-------equation 24
     bet_b = 0.5 + omega_b / omega + (3 - 2 * omega_b / omega) * np.sqrt((17.2 * omega * h ** 2) ** 2 + 1)
+    bnode = 8.41 * (omega * h ** 2) ** 0.435
+
+    return TransferCoefficients(omega, omega_b, h, theta_cmb, z_eq, k_eq, z_d, Rd, s, ks, al_c, bet_c, al_b, bet_b,
+                                bnode)
+
+
+@lru_cache(maxsize=128)
+def _cached_coefficients(omega, omega_b, h, Tcmb):
+    """transfer_coefficients of a scalar cosmology, computed once"""
+    return transfer_coefficients(omega, omega_b, h, Tcmb)
+
+
+def transfer_workspace(shape):
+    """
+    Preallocated buffers for transfer, to be reused between calls on wavenumbers of the same shape
+    :param shape: tuple : shape of the output, broadcast of k and of the cosmological parameters
+    :return: list of 6 arrays
+    """
+    return [np.empty(shape) for i in range(6)]
+
+
+def transfer(k, omega=cp.om, omega_b=cp.omb, h=cp.h, Tcmb=cp.Tcmb, coefs=None, work=None):
+    """
+    Transfer function from Eisenstein and Hu 1998. Every k dependent term is computed once, in place in a workspace of 6
+    buffers, with the operations of transfer_reference in the same order so that the results are identical.
+    :param k : wave number
+    :param omega: fraction density of matter
+    :param omega_b: fraction density of baryons
+    :param h: normalized hubble value
+    :param Tcmb: CMB temperature
+    :param coefs: TransferCoefficients : precomputed constants of the cosmology. If given, omega, omega_b, h and Tcmb
+    are ignored. Otherwise they are computed, and cached for scalar parameters. Arrays of parameters of shape
+    (n_cosmo, 1) with k of shape (1, n_k) give the (n_cosmo, n_k) transfer functions in a single evaluation
+    :param work: list of arrays : workspace from transfer_workspace. Default : allocated for this call
+    :return: transfer function
+    """
+    if coefs is None:
+        if np.ndim(omega) == np.ndim(omega_b) == np.ndim(h) == np.ndim(Tcmb) == 0:
+            coefs = _cached_coefficients(float(omega), float(omega_b), float(h), float(Tcmb))
+        else:
+            coefs = transfer_coefficients(omega, omega_b, h, Tcmb)
+    omega, omega_b, h, theta_cmb = coefs.omega, coefs.omega_b, coefs.h, coefs.theta_cmb
+    s, bet_c, al_b, bet_b, ks = coefs.s, coefs.bet_c, coefs.al_b, coefs.bet_b, coefs.ks
+    if work is None:
+        work = transfer_workspace(np.broadcast(k, omega).shape)
+    kts, b1, b2, b3, b4, b5 = work
+
+    np.multiply(k, s, out=kts)  # k*s, used 4 times
+
+    ##-------equation  10
+    np.multiply(theta_cmb ** 2, k, out=b1)
+    nq = np.divide(b1, omega * h ** 2, out=b1)  # normalized wavenumber
+    q2 = np.square(nq, out=b2)
+
+    ##-------equation 20
+    D = np.power(nq, 1.08, out=b3)
+    np.multiply(D, 69.9, out=D)
+    np.add(D, 1, out=D)
+    np.divide(386, D, out=D)  # 386 / (1 + 69.9 * nq ** 1.08)
+
+    ##-------equation 19, log shared by T0 and T01
+    L = np.multiply(nq, 1.8 * bet_c, out=b4)
+    np.add(L, np.e, out=L)
+    np.log(L, out=L)
+    T0 = np.add(D, 14.2 / coefs.al_c, out=b5)  # C
+    np.multiply(T0, q2, out=T0)
+    np.add(L, T0, out=T0)
+    np.divide(L, T0, out=T0)
+    C1q2 = np.add(D, 14.2, out=b3)  # C1
+    np.multiply(C1q2, q2, out=C1q2)
+    T01 = np.add(L, C1q2, out=b2)
+    np.divide(L, T01, out=T01)
+    L1 = np.multiply(nq, 1.8, out=b4)  # T011 is T01 with bet_c = 1
+    np.add(L1, np.e, out=L1)
+    np.log(L1, out=L1)
+    np.add(L1, C1q2, out=C1q2)
+    T011 = np.divide(L1, C1q2, out=b4)
+
+    ##-------equation 18
+    f = np.divide(kts, 5.4, out=b1)
+    np.power(f, 4, out=f)
+    np.add(f, 1, out=f)
+    np.divide(1, f, out=f)
+
+    ##-------equation 17
+    Tc = np.multiply(f, T01, out=b2)
+    np.subtract(1, f, out=f)
+    np.multiply(f, T0, out=f)
+    np.add(Tc, f, out=Tc)
+
+    ##-------equation 22
+    st = np.divide(coefs.bnode, kts, out=b1)
+    np.power(st, 3, out=st)
+    np.add(st, 1, out=st)
+    np.power(st, 1 / 3, out=st)
+    np.divide(s, st, out=st)
+
+    ##-------equation 21
+    kst = np.multiply(k, st, out=b1)
+    ra2 = np.sin(kst, out=b5)
+    np.divide(ra2, kst, out=ra2)
+    ra1 = np.divide(kts, 5.2, out=b1)
+    np.square(ra1, out=ra1)
+    np.add(ra1, 1, out=ra1)
+    np.divide(T011, ra1, out=T011)
+    ra1 = np.divide(k, ks, out=b1)
+    np.power(ra1, 1.4, out=ra1)
+    np.negative(ra1, out=ra1)
+    np.exp(ra1, out=ra1)
+    np.multiply(ra1, al_b, out=ra1)
+    den = np.divide(bet_b, kts, out=b3)
+    np.power(den, 3, out=den)
+    np.add(den, 1, out=den)
+    np.divide(ra1, den, out=ra1)
+    ra1 = np.add(T011, ra1, out=T011)
+    Tb = np.multiply(ra1, ra2, out=ra1)
+
+    ##-------equation 16
+    np.multiply(Tb, omega_b / omega, out=Tb)
+    np.multiply(Tc, 1 - omega_b / omega, out=Tc)
+    return np.add(Tb, Tc)[()]
+
+
+def transfer_reference(k, omega=cp.om, omega_b=cp.omb, h=cp.h, Tcmb=cp.Tcmb, coefs=None):
+    """
+    Transfer function from Eisenstein and Hu 1998, direct transcription of the equations. Reference for transfer
+    :param k : wave number
+    :param omega: fraction density of matter
+    :param omega_b: fraction density of baryons
+    :param h: normalized hubble value
+    :param Tcmb: CMB temperature
+    :param coefs: TransferCoefficients : precomputed constants of the cosmology. If given, omega, omega_b, h and Tcmb
+    are ignored. Otherwise they are computed, and cached for scalar parameters. Arrays of parameters of shape
+    (n_cosmo, 1) with k of shape (1, n_k) give the (n_cosmo, n_k) transfer functions in a single evaluation
+    :return: transfer function
+    """
+    if coefs is None:
+        if np.ndim(omega) == np.ndim(omega_b) == np.ndim(h) == np.ndim(Tcmb) == 0:
+            coefs = _cached_coefficients(float(omega), float(omega_b), float(h), float(Tcmb))
+        else:
+            coefs = transfer_coefficients(omega, omega_b, h, Tcmb)
+    omega, omega_b, h, theta_cmb = coefs.omega, coefs.omega_b, coefs.h, coefs.theta_cmb
+    s, bet_c, al_b, bet_b, ks = coefs.s, coefs.bet_c, coefs.al_b, coefs.bet_b, coefs.ks
+
+    ##-------equation  10
+    nq = theta_cmb**2*k/(omega*h**2)   #normalized wavenumber
 
     ##-------equation 18
     f = 1/(1 + (k*s/5.4)**4)
 
     ##-------equation 20
-    C = 14.2 / al_c + 386 / (1 + 69.9 * nq ** 1.08)
+    C = 14.2 / coefs.al_c + 386 / (1 + 69.9 * nq ** 1.08)
     C1 = 14.2 + 386 / (1 + 69.9 * nq ** 1.08)
 
     ##-------equation 19
@@ -80,11 +229,8 @@ def transfer(k, omega=cp.om, omega_b=cp.omb, h=cp.h, Tcmb=cp.Tcmb):
     ##-------equation 17
     Tc = f*T01 + (1-f)*T0
 
-    ##-------equation 24
-    bnode = 8.41 * (omega * h ** 2) ** 0.435
-
     ##-------equation 22
-    st = s / (1 + (bnode / (k * s)) ** 3) ** (1 / 3)
+    st = s / (1 + (coefs.bnode / (k * s)) ** 3) ** (1 / 3)
 
     ##-------equation 21
     ra1 = T011 / (1 + (k * s / 5.2) ** 2) + al_b * np.exp(-(k / ks) ** 1.4) / (1 + (bet_b / (k * s)) ** 3)
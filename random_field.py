@@ -1,23 +1,28 @@
 import numpy as np
-from fluctuation_rms import power_spectrum
+from fluctuation_rms import power_spectrum, sigma_integral, sigma_gauss
 import cosmo_parameters as cp
 
 
+def W_none(k, R):
+    """No smoothing"""
+    return np.ones_like(k * R)
 
-def sig(sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ns=cp.ns, test= False, prec=1000):
 
+def sig(sig8=cp.sigma8, h=cp.h, omb=cp.omb, om0=cp.om, ns=cp.ns, test= False, prec=1000, quad='rect', err=False):
+
+    if quad == 'gauss':
+        def pk_func(k):
+            return power_spectrum(k, sig8, h, om0, omb, ns, test)
+        return sigma_gauss(1e-5, pk_func, 1e-7, 1e5, W_none, err=err)  # kmax R = 1, no oscillating part
 
     prec=10*prec   # having more bins is less expensive than in the camb power spectrum case
+    if quad == 'simpson':
+        prec = prec + 1  # Simpson's rule needs an odd number of points
     k = np.logspace(-7, 5, prec)  #creating a k array in log space for the integration
     pk = power_spectrum(k, sig8, h, om0, omb, ns, test)  #corresponding power spectrum values
 
     # In units of Mpc/h
-    m = prec  # size of wavenumbers imput
-
-    dlk = np.log(np.max(k) / np.min(k)) / len(k)  # element of k for approximating the integral
-    res = pk * k ** 3  # Values inside the integral foreach k
-    integ = np.sum(res) * dlk  # approximate evaluation of the integral through k.
-    return np.sqrt(integ / (2 * np.pi ** 2))
+    return sigma_integral(1.0, k, pk, W_none, quad=quad, err=err)
 
 
 def ksharp(r, R):